@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Benchmark the examples against emulated devices or real LoStiks.
+
+Measures command round-trip latency, configure.py provisioning wall time for
+the RN2483 (16 channel) and RN2903 (72 channel) configs, the packets per
+second achieved on the radio_sender -> radio_receiver path and the bytes per
+second miniterm's rx filters get through, fused and with the per-character
+filter chain miniterm used before. Results are written as JSON so they can be compared between releases.
+
+    ./benchmark.py --output bench.json
+    ./benchmark.py --port /dev/ttyUSB0 --receiver-port /dev/ttyUSB1
+"""
+import argparse
+import configparser
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import serial
+from serial.threaded import ReaderThread
+
+from lostik import LoStik, CommandTimeout, wait_for_module
+import miniterm
+import rn2xx3_emulator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CONFIGS = {
+    'RN2483': os.path.join(HERE, 'ttn-eu.conf'),
+    'RN2903': os.path.join(HERE, 'ttn-us.conf'),
+}
+
+LATENCY_COMMANDS = (
+    'sys get ver',
+    'radio get sf',
+    'sys set pindig GPIO10 0',
+)
+
+# miniterm filter chains to time, as given to --filter
+MINITERM_FILTERS = (
+    ('default',),
+    ('printable',),
+    ('nocontrol', 'colorize'),
+    ('default', 'printable'),
+)
+
+# Used when a channel plan has no credentials of its own
+DUMMY_OTAA = {
+    'appeui': '70B3D57ED0000000',
+    'deveui': '0004A30B00000000',
+    'appkey': '00000000000000000000000000000001',
+}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not samples:
+        return None
+    rank = max(int(round(pct / 100.0 * len(samples) + .5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples) if samples else None,
+        'min': samples[0] if samples else None,
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': samples[-1] if samples else None,
+    }
+
+
+def bench_latency(stik, count):
+    results = {}
+    for cmd in LATENCY_COMMANDS:
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            stik.command(cmd)
+            samples.append(time.perf_counter() - start)
+        results[cmd] = summarize(samples)
+    return results
+
+
+def _printable_rx(text):
+    """Printable.rx as it was before the filters were fused, as a baseline"""
+    r = []
+    for c in text:
+        if ' ' <= c < '\x7f' or c in '\r\n\b\t':
+            r.append(c)
+        elif c < ' ':
+            r.append(chr(0x2400 + ord(c)))
+        else:
+            r.extend(chr(0x2080 + ord(d) - 48) for d in '{:d}'.format(ord(c)))
+            r.append(' ')
+    return ''.join(r)
+
+
+def _baseline_rx(transformation):
+    if isinstance(transformation, miniterm.Printable):
+        return _printable_rx
+    return transformation.rx
+
+
+def bench_miniterm(size, chunk=1024):
+    """Bytes per second through miniterm's rx filters, the old chain vs fused"""
+    line = 'radio_rx  %s\r\n' % ('48656C6C6F\x00\x1b\xe9' * 4)
+    text = (line * (size // len(line) + 1))[:size]
+    chunks = [text[i:i + chunk] for i in range(0, len(text), chunk)]
+    results = {}
+    for filters in MINITERM_FILTERS:
+        transformations = [miniterm.EOL_TRANSFORMATIONS['crlf']()] + [
+            miniterm.TRANSFORMATIONS[f]() for f in filters]
+        rx_transformations = list(reversed(transformations))
+        pipeline = miniterm.rx_pipeline(rx_transformations)
+        chain = [_baseline_rx(transformation) for transformation in rx_transformations]
+        start = time.perf_counter()
+        for data in chunks:
+            for rx in chain:
+                data = rx(data)
+        baseline = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in chunks:
+            for rx in pipeline:
+                data = rx(data)
+        fused = time.perf_counter() - start
+        results[' '.join(filters)] = {
+            'baseline_bytes_per_second': size / baseline,
+            'fused_bytes_per_second': size / fused,
+        }
+    return results
+
+
+def provisioning_config(path):
+    """Return a config file for configure.py, adding OTAA credentials if missing"""
+    config = configparser.ConfigParser()
+    config.read(path)
+    if not config.has_section('mac'):
+        config['mac'] = {'auth': 'otaa'}
+    if config.get('mac', 'auth') != 'otaa':
+        return path
+    if not config.has_section('otaa'):
+        config.add_section('otaa')
+    missing = [k for k in DUMMY_OTAA if not config.has_option('otaa', k)]
+    if not missing:
+        return path
+    for key in missing:
+        config.set('otaa', key, DUMMY_OTAA[key])
+    handle, tmp = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(handle, 'w') as f:
+        config.write(f)
+    return tmp
+
+
+def bench_provisioning(port, config_path):
+    """Wall time of a complete configure.py run"""
+    config = provisioning_config(config_path)
+    try:
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, os.path.join(HERE, 'configure.py'), port, config],
+                              stdout=subprocess.DEVNULL)
+        return time.perf_counter() - start
+    finally:
+        if config != config_path:
+            os.unlink(config)
+
+
+def setup_radio(stik):
+    stik.command('mac pause')
+    stik.command_ok('radio set pwr 10')
+
+
+def bench_throughput(sender, receiver, duration):
+    """Send back to back for duration seconds and count frames the receiver hears"""
+    setup_radio(sender)
+    setup_radio(receiver)
+    received = [0]
+    stop = threading.Event()
+
+    def receive():
+        while not stop.is_set():
+            receiver.clear_events()
+            receiver.command_ok('radio rx 0')
+            while not stop.is_set():
+                try:
+                    line = receiver.wait_event(.2)
+                except CommandTimeout:
+                    continue
+                if line.startswith('radio_rx'):
+                    received[0] += 1
+                break
+
+    thread = threading.Thread(target=receive, name='receiver')
+    thread.daemon = True
+    thread.start()
+    time.sleep(.1)
+
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        if sender.transact('radio tx %08x%08x' % (int(time.time()), sent)) == 'radio_tx_ok':
+            sent += 1
+    elapsed = time.perf_counter() - start
+    time.sleep(.5)
+    stop.set()
+    thread.join()
+    return {
+        'seconds': elapsed,
+        'sent': sent,
+        'received': received[0],
+        'packets_per_second': received[0] / elapsed,
+    }
+
+
+def open_stik(ser):
+    reader = ReaderThread(ser, LoStik)
+    reader.start()
+    return reader, reader.connect()[1]
+
+
+def run_emulated(args):
+    timing = rn2xx3_emulator.TimingModel(speed=args.speed)
+    results = {'provisioning': {}}
+    for sku in sorted(CONFIGS):
+        device = rn2xx3_emulator.Device(sku, timing)
+        port = rn2xx3_emulator.serve_pty(device)
+        results['provisioning'][sku] = bench_provisioning(port, CONFIGS[sku])
+        device.close()
+
+    reader, stik = open_stik(rn2xx3_emulator.EmulatedSerial(rn2xx3_emulator.Device('RN2903', timing)))
+    results['latency'] = bench_latency(stik, args.count)
+    reader.close()
+
+    ether = rn2xx3_emulator.Ether()
+    tx_reader, sender = open_stik(rn2xx3_emulator.EmulatedSerial(
+        rn2xx3_emulator.Device('RN2903', timing, ether)))
+    rx_reader, receiver = open_stik(rn2xx3_emulator.EmulatedSerial(
+        rn2xx3_emulator.Device('RN2903', timing, ether)))
+    results['throughput'] = bench_throughput(sender, receiver, args.duration)
+    tx_reader.close()
+    rx_reader.close()
+    return results
+
+
+def run_hardware(args):
+    results = {}
+    reader, stik = open_stik(serial.Serial(args.port, baudrate=57600))
+    verinfo = wait_for_module(stik)
+    results['device'] = verinfo
+    results['latency'] = bench_latency(stik, args.count)
+    reader.close()
+
+    sku = 'RN2483' if 'RN2483' in verinfo else 'RN2903'
+    results['provisioning'] = {sku: bench_provisioning(args.port, args.config or CONFIGS[sku])}
+
+    if args.receiver_port:
+        tx_reader, sender = open_stik(serial.Serial(args.port, baudrate=57600))
+        rx_reader, receiver = open_stik(serial.Serial(args.receiver_port, baudrate=57600))
+        results['throughput'] = bench_throughput(sender, receiver, args.duration)
+        tx_reader.close()
+        rx_reader.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark LoStik examples')
+    parser.add_argument('--port', help="Serial port of a LoStik (default: emulator)")
+    parser.add_argument('--receiver-port', help="Second LoStik for the throughput test")
+    parser.add_argument('--config', help="Configuration file for the provisioning test")
+    parser.add_argument('--count', '-c', help="Round trips per command", type=int, default=100)
+    parser.add_argument('--duration', help="Seconds to transmit for", type=float, default=10)
+    parser.add_argument('--speed', help="Emulator time scale", type=float, default=1.0)
+    parser.add_argument('--miniterm-bytes', help="Text to run through miniterm filters",
+                        type=int, default=4000000)
+    parser.add_argument('--output', '-o', help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'pyserial': serial.VERSION,
+        'target': args.port or 'emulator',
+    }
+    if args.port:
+        report['results'] = run_hardware(args)
+    else:
+        report['speed'] = args.speed
+        report['results'] = run_emulated(args)
+    report['results']['miniterm'] = bench_miniterm(args.miniterm_bytes)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Append-only binary capture of received LoRa frames.
+
+A capture file is a 16 byte header followed by frame records. After every
+index_interval records an index block is appended that describes the chunk of
+records before it (time range, offset, count) and points at the previous
+index block. Readers locate the last index block from the end of the file and
+follow the chain, so a time range can be sliced without scanning every record.
+
+    with CaptureWriter('rx.cap') as capture:
+        capture.write(time.time(), 868100000, 7, 125, -60, 9, payload)
+
+    for frame in CaptureReader('rx.cap').frames(start, end):
+        print(frame.timestamp, frame.payload.hex())
+
+Run as a script to dump a capture, optionally limited to a time range.
+"""
+import argparse
+import bisect
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+MAGIC = b'LSTKCAP1'
+VERSION = 1
+HEADER = struct.Struct('<8sHHI')
+# type, timestamp, freq, sf, bw, rssi, snr, payload length
+RECORD = struct.Struct('<cdIBHhbH')
+RECORD_TYPE = b'R'
+# magic, own offset, previous index offset, chunk offset, records, first/last timestamp
+INDEX = struct.Struct('<4sQQQIdd')
+INDEX_MAGIC = b'LSIX'
+
+NO_RSSI = -32768
+NO_SNR = -128
+
+CaptureFrame = namedtuple('CaptureFrame', 'timestamp freq sf bw rssi snr payload')
+Chunk = namedtuple('Chunk', 'first last offset count')
+
+
+class CaptureWriter(object):
+
+    def __init__(self, path, index_interval=256):
+        self.path = path
+        self.index_interval = index_interval
+        self.prev_index = 0
+        self.chunk = None
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            reader = CaptureReader(path)
+            self.prev_index = reader.last_index
+            self.chunk = reader.tail
+            self.index_interval = reader.index_interval
+            end = reader.end
+            reader.close()
+        self.file = open(path, 'r+b' if exists else 'wb')
+        if exists:
+            # drop a record truncated by a crash
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file.write(HEADER.pack(MAGIC, VERSION, self.index_interval, 0))
+
+    def write(self, timestamp, freq, sf, bw, rssi, snr, payload):
+        offset = self.file.tell()
+        self.file.write(RECORD.pack(
+            RECORD_TYPE, timestamp, freq, sf, bw,
+            NO_RSSI if rssi is None else rssi,
+            NO_SNR if snr is None else snr,
+            len(payload)))
+        self.file.write(payload)
+        if self.chunk is None:
+            self.chunk = Chunk(timestamp, timestamp, offset, 1)
+        else:
+            self.chunk = Chunk(min(self.chunk.first, timestamp), max(self.chunk.last, timestamp),
+                               self.chunk.offset, self.chunk.count + 1)
+        if self.chunk.count >= self.index_interval:
+            self.write_index()
+
+    def write_index(self):
+        if self.chunk is None:
+            return
+        offset = self.file.tell()
+        self.file.write(INDEX.pack(INDEX_MAGIC, offset, self.prev_index, self.chunk.offset,
+                                   self.chunk.count, self.chunk.first, self.chunk.last))
+        self.prev_index = offset
+        self.chunk = None
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.write_index()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CaptureReader(object):
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if len(self.map) < HEADER.size:
+            raise ValueError('%s is not a capture file' % path)
+        magic, version, self.index_interval, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a capture file' % path)
+        self.last_index = self._find_last_index()
+        self.chunks = self._read_index_chain()
+        self.tail, self.end = self._scan_tail()
+        if self.tail is not None:
+            self.chunks.append(self.tail)
+        self._lasts = [chunk.last for chunk in self.chunks]
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def _find_last_index(self):
+        pos = len(self.map)
+        while True:
+            pos = self.map.rfind(INDEX_MAGIC, HEADER.size, pos)
+            if pos < 0:
+                return 0
+            if pos + INDEX.size <= len(self.map) and INDEX.unpack_from(self.map, pos)[1] == pos:
+                return pos
+
+    def _read_index_chain(self):
+        chunks = []
+        offset = self.last_index
+        while offset:
+            _, _, prev, chunk_offset, count, first, last = INDEX.unpack_from(self.map, offset)
+            chunks.append(Chunk(first, last, chunk_offset, count))
+            offset = prev
+        chunks.reverse()
+        return chunks
+
+    def _scan_tail(self):
+        """Records written after the last index block (unindexed)"""
+        offset = self.last_index + INDEX.size if self.last_index else HEADER.size
+        chunk = None
+        while offset + RECORD.size <= len(self.map):
+            fields = RECORD.unpack_from(self.map, offset)
+            end = offset + RECORD.size + fields[-1]
+            if fields[0] != RECORD_TYPE or end > len(self.map):
+                break
+            if chunk is None:
+                chunk = Chunk(fields[1], fields[1], offset, 1)
+            else:
+                chunk = Chunk(min(chunk.first, fields[1]), max(chunk.last, fields[1]),
+                              chunk.offset, chunk.count + 1)
+            offset = end
+        return chunk, offset
+
+    def __len__(self):
+        return sum(chunk.count for chunk in self.chunks)
+
+    def _records(self, chunk):
+        offset = chunk.offset
+        for _ in range(chunk.count):
+            fields = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            offset = start + fields[-1]
+            yield fields, start
+
+    def frames(self, start=None, end=None):
+        """Yield CaptureFrames with start <= timestamp < end"""
+        first = 0 if start is None else bisect.bisect_left(self._lasts, start)
+        for chunk in self.chunks[first:]:
+            if end is not None and chunk.first >= end:
+                break
+            for fields, offset in self._records(chunk):
+                _, timestamp, freq, sf, bw, rssi, snr, length = fields
+                if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                    continue
+                yield CaptureFrame(timestamp, freq, sf, bw,
+                                   None if rssi == NO_RSSI else rssi,
+                                   None if snr == NO_SNR else snr,
+                                   bytes(self.map[offset:offset + length]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print frames from a capture file')
+    parser.add_argument('capture', help="Capture file")
+    parser.add_argument('--start', help="Unix time of the first frame", type=float)
+    parser.add_argument('--end', help="Unix time after the last frame", type=float)
+    args = parser.parse_args()
+
+    with CaptureReader(args.capture) as reader:
+        for frame in reader.frames(args.start, args.end):
+            print('%.3f %d sf%d %d rssi=%s snr=%s %s' % (
+                frame.timestamp, frame.freq, frame.sf, frame.bw, frame.rssi, frame.snr,
+                frame.payload.hex().upper()))
+
+
+if __name__ == '__main__':
+    main()
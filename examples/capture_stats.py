@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Statistics over capture files written by radio_receiver.py --capture.
+
+Frames are loaded in batches straight from the memory mapped capture into
+NumPy arrays, so memory stays bounded by --batch no matter how large the
+capture is. Reports packet error rate from radio_sender.py's
+(timestamp, frame_count) payloads, RSSI/SNR distributions, inter-arrival
+times and a per-frequency breakdown.
+
+Requires NumPy (pip install numpy).
+
+    ./capture_stats.py rx.cap
+    ./capture_stats.py --json rx.cap other.cap
+"""
+import argparse
+import json
+
+import numpy as np
+
+from capture import CaptureReader, NO_RSSI, NO_SNR, RECORD, RECORD_TYPE
+
+RSSI_RANGE = (-160, 0)
+SNR_RANGE = (-40, 30)
+# inter-arrival bins in seconds, log spaced from 1 ms to ~1 day
+INTERVAL_BINS = np.logspace(-3, 5, 33)
+
+# radio_sender.py payload: big endian unix time and frame counter
+SENDER_DTYPE = np.dtype([('time', '>u4'), ('frame', '>u4')])
+
+
+# what is kept of every frame; frame is radio_sender.py's counter or -1
+FRAME_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('freq', '<u4'),
+    ('rssi', '<i2'),
+    ('snr', 'i1'),
+    ('frame', '<i8'),
+])
+
+
+def record_dtype(length):
+    """Layout of a capture record with a payload of length bytes"""
+    return np.dtype([
+        ('type', 'S1'),
+        ('timestamp', '<f8'),
+        ('freq', '<u4'),
+        ('sf', 'u1'),
+        ('bw', '<u2'),
+        ('rssi', '<i2'),
+        ('snr', 'i1'),
+        ('length', '<u2'),
+        ('payload', 'V%d' % length),
+    ])
+
+
+def compact(records):
+    frames = np.empty(len(records), FRAME_DTYPE)
+    for name in ('timestamp', 'freq', 'rssi', 'snr'):
+        frames[name] = records[name]
+    if records.dtype['payload'].itemsize == SENDER_DTYPE.itemsize:
+        counters = records['payload'].view(SENDER_DTYPE)['frame'].astype(np.int64)
+        frames['frame'] = np.where(records['length'] == SENDER_DTYPE.itemsize, counters, -1)
+    else:
+        frames['frame'] = -1
+    return frames
+
+
+def chunk_frames(reader, chunk):
+    """
+    Frames of one index chunk. Chunks whose records all have the same
+    payload length (the common case) are read as a single strided view of
+    the mapped file; mixed chunks are walked record by record.
+    """
+    length = RECORD.unpack_from(reader.map, chunk.offset)[-1]
+    dtype = record_dtype(length)
+    if chunk.offset + dtype.itemsize * chunk.count <= len(reader.map):
+        records = np.frombuffer(reader.map, dtype, chunk.count, chunk.offset)
+        if (records['length'] == length).all() and (records['type'] == RECORD_TYPE).all():
+            return compact(records)
+    records = np.zeros(chunk.count, record_dtype(SENDER_DTYPE.itemsize))
+    for i, (fields, offset) in enumerate(reader._records(chunk)):
+        payload = bytes(reader.map[offset:offset + min(fields[-1], SENDER_DTYPE.itemsize)])
+        records[i] = fields + (payload.ljust(SENDER_DTYPE.itemsize, b'\0'),)
+    return compact(records)
+
+
+def batches(paths, batch):
+    """Yield arrays of FRAME_DTYPE holding about batch frames each"""
+    pending, count = [], 0
+    for path in paths:
+        with CaptureReader(path) as reader:
+            for chunk in reader.chunks:
+                pending.append(chunk_frames(reader, chunk))
+                count += chunk.count
+                if count >= batch:
+                    yield np.concatenate(pending)
+                    pending, count = [], 0
+    if pending:
+        yield np.concatenate(pending)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.frames = 0
+        self.first = None
+        self.last = None
+        self.rssi_hist = np.zeros(RSSI_RANGE[1] - RSSI_RANGE[0] + 1, np.int64)
+        self.snr_hist = np.zeros(SNR_RANGE[1] - SNR_RANGE[0] + 1, np.int64)
+        self.interval_hist = np.zeros(len(INTERVAL_BINS) - 1, np.int64)
+        self.per_freq = {}
+        # sender sessions: [first frame, last frame, frames received]
+        self.sessions = []
+        self._last_timestamp = None
+        self._last_frame = None
+
+    def add(self, frames):
+        timestamps = frames['timestamp']
+        freqs = frames['freq']
+        rssi = frames['rssi'].astype(np.int64)
+        snr = frames['snr'].astype(np.int64)
+        if not len(timestamps):
+            return
+        self.frames += len(timestamps)
+        self.first = timestamps.min() if self.first is None else min(self.first, timestamps.min())
+        self.last = timestamps.max() if self.last is None else max(self.last, timestamps.max())
+
+        valid = rssi != NO_RSSI
+        self.rssi_hist += np.bincount(
+            np.clip(rssi[valid], *RSSI_RANGE) - RSSI_RANGE[0], minlength=len(self.rssi_hist))
+        valid_snr = snr != NO_SNR
+        self.snr_hist += np.bincount(
+            np.clip(snr[valid_snr], *SNR_RANGE) - SNR_RANGE[0],
+            minlength=len(self.snr_hist))
+
+        if self._last_timestamp is not None:
+            timestamps = np.concatenate(([self._last_timestamp], timestamps))
+        self.interval_hist += np.histogram(np.diff(timestamps), INTERVAL_BINS)[0]
+        self._last_timestamp = timestamps[-1]
+
+        keys, inverse = np.unique(freqs, return_inverse=True)
+        counts = np.bincount(inverse)
+        rssi_sum = np.bincount(inverse[valid], rssi[valid], len(keys))
+        rssi_n = np.bincount(inverse[valid], minlength=len(keys))
+        snr_sum = np.bincount(inverse[valid_snr], snr[valid_snr], len(keys))
+        snr_n = np.bincount(inverse[valid_snr], minlength=len(keys))
+        for i, freq in enumerate(keys.tolist()):
+            entry = self.per_freq.setdefault(freq, np.zeros(5))
+            entry += (counts[i], rssi_sum[i], rssi_n[i], snr_sum[i], snr_n[i])
+
+        self.add_sender_frames(frames['frame'])
+
+    def add_sender_frames(self, frames):
+        frames = frames[frames >= 0]
+        if not len(frames):
+            return
+        if self._last_frame is not None:
+            frames = np.concatenate(([self._last_frame], frames))
+            carried = True
+        else:
+            carried = False
+        steps = np.diff(frames)
+        # a counter going backwards means radio_sender.py was restarted
+        starts = np.flatnonzero(steps < 0) + 1
+        fresh = np.concatenate(([not carried], steps != 0))
+        for i, segment in enumerate(np.split(np.arange(len(frames)), starts)):
+            if not len(segment):
+                continue
+            first, last = frames[segment[0]], frames[segment[-1]]
+            received = int(fresh[segment].sum())
+            if i == 0 and carried and self.sessions:
+                session = self.sessions[-1]
+                session[1] = int(last)
+                session[2] += received
+            else:
+                self.sessions.append([int(first), int(last), received])
+        self._last_frame = frames[-1]
+
+    def report(self):
+        expected = sum(last - first + 1 for first, last, _ in self.sessions)
+        received = sum(n for _, _, n in self.sessions)
+        return {
+            'frames': self.frames,
+            'first': self.first,
+            'last': self.last,
+            'per': {
+                'sessions': len(self.sessions),
+                'expected': expected,
+                'received': received,
+                'packet_error_rate': 1 - received / float(expected) if expected else None,
+            },
+            'rssi': histogram_summary(self.rssi_hist, RSSI_RANGE[0]),
+            'snr': histogram_summary(self.snr_hist, SNR_RANGE[0]),
+            'inter_arrival': {
+                'bins': INTERVAL_BINS.tolist(),
+                'counts': self.interval_hist.tolist(),
+            },
+            'frequencies': dict(
+                (str(freq), {
+                    'frames': int(v[0]),
+                    'rssi_mean': v[1] / v[2] if v[2] else None,
+                    'snr_mean': v[3] / v[4] if v[4] else None,
+                }) for freq, v in sorted(self.per_freq.items())),
+        }
+
+
+def histogram_summary(hist, offset):
+    total = int(hist.sum())
+    if not total:
+        return {'count': 0}
+    values = np.arange(len(hist)) + offset
+    cumulative = np.cumsum(hist)
+
+    def percentile(pct):
+        return int(values[np.searchsorted(cumulative, pct / 100.0 * total)])
+
+    return {
+        'count': total,
+        'mean': float((hist * values).sum() / total),
+        'min': int(values[np.flatnonzero(hist)[0]]),
+        'p10': percentile(10),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'max': int(values[np.flatnonzero(hist)[-1]]),
+        'histogram': dict((int(v), int(c)) for v, c in zip(values, hist) if c),
+    }
+
+
+def print_report(report):
+    print("Frames: %d" % report['frames'])
+    per = report['per']
+    if per['expected']:
+        print("Packet error rate: %.2f%% (%d of %d frames in %d sender sessions)" % (
+            100 * per['packet_error_rate'], per['expected'] - per['received'],
+            per['expected'], per['sessions']))
+    for name in ('rssi', 'snr'):
+        summary = report[name]
+        if summary['count']:
+            print("%s: mean %.1f, min %d, p10 %d, p50 %d, p90 %d, max %d" % (
+                name.upper(), summary['mean'], summary['min'], summary['p10'],
+                summary['p50'], summary['p90'], summary['max']))
+    print("Inter-arrival times:")
+    bins = report['inter_arrival']['bins']
+    for i, count in enumerate(report['inter_arrival']['counts']):
+        if count:
+            print("  %10.3fs - %10.3fs: %d" % (bins[i], bins[i + 1], count))
+    print("Frequencies:")
+    for freq, entry in report['frequencies'].items():
+        print("  %s: %d frames, rssi %s, snr %s" % (
+            freq, entry['frames'],
+            '-' if entry['rssi_mean'] is None else '%.1f' % entry['rssi_mean'],
+            '-' if entry['snr_mean'] is None else '%.1f' % entry['snr_mean']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture file statistics')
+    parser.add_argument('captures', nargs='+', help="Capture files, in time order")
+    parser.add_argument('--batch', help="Frames loaded at a time", type=int, default=1000000)
+    parser.add_argument('--json', help="Print JSON instead of text", action='store_true')
+    args = parser.parse_args()
+
+    stats = Stats()
+    for frames in batches(args.captures, args.batch):
+        stats.add(frames)
+    report = stats.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,24 @@
 ##!/usr/bin/env python3
 
 import serial
+import sys
+import hashlib
 import time
 import io
+import glob
 import argparse
 import configparser
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from serial.threaded import ReaderThread
 
+from lostik import LoStik, CommandTimeout, NVM_END, wait_for_module, read_nvm, write_nvm
+from discovery import candidate_ports, resolve
 
-parser = argparse.ArgumentParser(description='Configure LoStik device')
-parser.add_argument('port', help="Serial port of LoStik")
-parser.add_argument('config', help="Configuration File")
-parser.add_argument('--debug', '-d', help="Print debug output", action='store_const', const=True, default=False)
-
-args = parser.parse_args()
-
-config = configparser.ConfigParser()
-config.read(args.config)
-
-ser = serial.Serial(args.port, baudrate=57600, timeout=10)
+# Last bytes of user NVM hold a hash of the applied configuration
+FINGERPRINT_SIZE = 4
+FINGERPRINT_ADDRESS = NVM_END + 1 - FINGERPRINT_SIZE
+FINGERPRINT_ERASED = b'\xff' * FINGERPRINT_SIZE
 
 
 # Print iterations progress
@@ -38,114 +39,339 @@ def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1,
     bar = fill * filledLength + '-' * (length - filledLength)
     print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end = '\r')
     # Print New Line on Complete
-    if iteration == total: 
+    if iteration == total:
         print()
 
-# import pdb; pdb.set_trace()
-def send_cmd(cmd):
-    if args.debug:
-        print(cmd)
-    ser.write(("%s\r\n"% cmd).encode("UTF-8"))
-    time.sleep(.2)
-
-def get_var(cmd):
-    send_cmd(cmd)
-    var = ser.readline().strip().decode("UTF8")
-    if args.debug:
-        print(var)
-    return var
-
-def set_confirm(cmd):
-    res = get_var(cmd)
-    if args.debug:
-        print(res)
-
-    if res != "ok":
-        raise Exception("Error in command: %s\r\n Response: %s" % (cmd, res))
-
-max_ch = 72
-sku = "RN2903"
-
-send_cmd('sys get ver')
-verinfo = ser.readline().decode("UTF-8")
-if not verinfo:
-    print("Timeout connecting to device")
-    exit()
-
-if("RN2483" in verinfo):
-    sku = "RN2483"
-    max_ch = 16
-elif "RN2903" in verinfo:
-    sku = "RN2903"
-else:
-    raise Exception("Invalid SKU")
-
-config_channels = config.items('channels')
-auth_method = config.get('mac', 'auth')
-
-print(verinfo.strip())
-print('Auth Method: %s' % auth_method)
-
-if auth_method == 'otaa':
-    print('Configuring otaa')
-    set_confirm('mac set appeui %s' % config.get('otaa', 'appeui'))
-    set_confirm('mac set appkey %s' % config.get('otaa', 'appkey'))
-    set_confirm('mac set deveui %s' % config.get('otaa', 'deveui'))
-elif auth_method == 'abp':
-    print('Configuring apb')
-    set_confirm('mac set devaddr %s' % config.get('abp', 'devaddr'))
-    set_confirm('mac set nwkskey %s' % config.get('abp', 'nwkskey'))
-    set_confrim('mac set appskey %s' % config.get('abp', 'appskey'))
-else:
-    raise Exception('Invaoid auth method %s' % auth_method)
-
-
-print("Configuring Channels:")
-ch_count = len(config_channels)
-i = 0
-
-def update_progress():
-    global i
-    i = i + 1
-    printProgressBar(i, ch_count, "Channels")
-    if args.debug:
-        print() # extra newline for progress bar
-
-for config_entry in config_channels:
-    config_fields = config_entry[1].split(',')
-    ch_id = int(config_entry[0].replace("ch", "").strip())
-
-    ch_freq = get_var('mac get ch freq %d' % ch_id)
-    config_freq = config_fields[0].replace('"', '').strip()
-    if config_freq == '':
-        update_progress()
-        continue
-        if args.debug:
-            print("Blank frequency on channel %d, skipping" % ch_id)
 
-    if(len(config_fields) >= 4):
-        config_drrange = "%d %d" % (int(config_fields[2]), int(config_fields[3]))
-        set_confirm('mac set ch drrange %d %s' % (ch_id, config_drrange))
+class Provisioner(object):
+    """
+    Applies one configuration file to one LoStik.
+
+    log and progress are called with status messages and (done, total)
+    channel counts so the same code can drive a single device on the
+    console or many devices from a worker pool.
+    """
 
-    if(len(config_fields) >= 5):
-        config_dcycle = int(config_fields[4])
-        set_confirm('mac set ch dcycle %d %d' % (ch_id, config_dcycle))
+    def __init__(self, stik, config, diff=False, log=print, progress=None, fingerprint=False):
+        self.stik = stik
+        self.config = config
+        self.diff = diff
+        self.fingerprint = fingerprint
+        self.stored_fingerprint = None
+        self.log = log
+        self.progress = progress
+        self.changes = 0
+        # writes of keys, which can not be compared with the device
+        self.key_writes = 0
+        self.max_ch = 72
+        self.sku = "RN2903"
+        self.verinfo = None
 
-    # US SKU has 72 fixed freq channels
-    # EU version has only 16 channels, but freq is user configurable on ch 3-15
-    if sku == "RN2903":
-        if config_freq != ch_freq:
-            raise Exception("Frequency %s for channel %s is does not match device." % (config_freq, ch_id))
-    else:
-        if ch_id < 3:
+    def get_var(self, cmd):
+        return self.stik.command(cmd)
+
+    def set_confirm(self, cmd):
+        self.stik.command_ok(cmd)
+
+    def apply(self, cmd, value, current=None):
+        """Send 'cmd value', unless diffing and the device already holds value"""
+        if self.diff and current is not None and value.upper() == current.upper():
+            return
+        self.set_confirm('%s %s' % (cmd, value))
+        self.changes = self.changes + 1
+
+    def write_key(self, cmd, value):
+        """
+        Send 'cmd value' for a key. The module can not report keys, so they
+        are always written but not counted in changes.
+        """
+        self.set_confirm('%s %s' % (cmd, value))
+        self.key_writes = self.key_writes + 1
+
+    def current(self, cmd):
+        """Read a setting in diff mode, None otherwise"""
+        if self.diff:
+            return self.get_var(cmd)
+        return None
+
+    def identify(self):
+        self.verinfo = wait_for_module(self.stik)
+        if("RN2483" in self.verinfo):
+            self.sku = "RN2483"
+            self.max_ch = 16
+        elif "RN2903" in self.verinfo:
+            self.sku = "RN2903"
+        else:
+            raise Exception("Invalid SKU")
+        self.log(self.verinfo.strip())
+
+    def config_fingerprint(self):
+        """Hash of everything this run would apply to the device"""
+        auth_method = self.config.get('mac', 'auth')
+        items = [self.sku, auth_method]
+        items.extend('%s=%s' % item for item in sorted(self.config.items(auth_method)))
+        items.extend('%s=%s' % item for item in self.config.items('channels'))
+        return hashlib.sha256('\n'.join(items).encode('UTF-8')).digest()[:FINGERPRINT_SIZE]
+
+    def is_configured(self):
+        """True if the fingerprint stored on the device matches the config"""
+        if not self.fingerprint:
+            return False
+        self.stored_fingerprint = read_nvm(self.stik, FINGERPRINT_ADDRESS, FINGERPRINT_SIZE)
+        return self.stored_fingerprint == self.config_fingerprint()
+
+    def clear_fingerprint(self):
+        """Invalidate the stored fingerprint before the device is changed"""
+        if self.fingerprint and self.stored_fingerprint != FINGERPRINT_ERASED:
+            write_nvm(self.stik, FINGERPRINT_ADDRESS, FINGERPRINT_ERASED)
+
+    def store_fingerprint(self):
+        if self.fingerprint:
+            write_nvm(self.stik, FINGERPRINT_ADDRESS, self.config_fingerprint())
+
+    def configure_auth(self):
+        config = self.config
+        auth_method = config.get('mac', 'auth')
+        self.log('Auth Method: %s' % auth_method)
+
+        if auth_method == 'otaa':
+            self.log('Configuring otaa')
+            self.apply('mac set appeui', config.get('otaa', 'appeui'), self.current('mac get appeui'))
+            self.apply('mac set deveui', config.get('otaa', 'deveui'), self.current('mac get deveui'))
+            self.write_key('mac set appkey', config.get('otaa', 'appkey'))
+        elif auth_method == 'abp':
+            self.log('Configuring apb')
+            self.apply('mac set devaddr', config.get('abp', 'devaddr'), self.current('mac get devaddr'))
+            self.write_key('mac set nwkskey', config.get('abp', 'nwkskey'))
+            self.write_key('mac set appskey', config.get('abp', 'appskey'))
+        else:
+            raise Exception('Invaoid auth method %s' % auth_method)
+
+    def configure_channels(self):
+        config_channels = self.config.items('channels')
+        self.log("Configuring Channels:")
+        ch_count = len(config_channels)
+
+        for i, config_entry in enumerate(config_channels, 1):
+            self.configure_channel(config_entry)
+            if self.progress:
+                self.progress(i, ch_count)
+
+    def configure_channel(self, config_entry):
+        config_fields = config_entry[1].split(',')
+        ch_id = int(config_entry[0].replace("ch", "").strip())
+
+        config_freq = config_fields[0].replace('"', '').strip()
+        if config_freq == '':
+            if self.stik.debug:
+                self.log("Blank frequency on channel %d, skipping" % ch_id)
+            return
+        config_status = config_fields[1].replace('"', '').strip()
+        if self.diff and config_status == 'off':
+            # the rest of a disabled channel doesn't matter, save the reads
+            self.apply('mac set ch status %d' % ch_id, config_status,
+                       self.current('mac get ch status %d' % ch_id))
+            return
+        ch_freq = self.get_var('mac get ch freq %d' % ch_id)
+
+        if(len(config_fields) >= 4):
+            config_drrange = "%d %d" % (int(config_fields[2]), int(config_fields[3]))
+            self.apply('mac set ch drrange %d' % ch_id, config_drrange,
+                       self.current('mac get ch drrange %d' % ch_id))
+
+        if(len(config_fields) >= 5):
+            config_dcycle = "%d" % int(config_fields[4])
+            self.apply('mac set ch dcycle %d' % ch_id, config_dcycle,
+                       self.current('mac get ch dcycle %d' % ch_id))
+
+        # US SKU has 72 fixed freq channels
+        # EU version has only 16 channels, but freq is user configurable on ch 3-15
+        if self.sku == "RN2903" or ch_id < 3:
             if config_freq != ch_freq:
                 raise Exception("Frequency %s for channel %s is does not match device." % (config_freq, ch_id))
         else:
-            set_confirm('mac set ch freq %d %s' % (ch_id, config_freq))
+            self.apply('mac set ch freq %d' % ch_id, config_freq, ch_freq)
+
+        self.apply('mac set ch status %d' % ch_id, config_status,
+                   self.current('mac get ch status %d' % ch_id))
+
+    def save(self):
+        # A fingerprint mismatch means the config, keys included, differs
+        # from what was saved last, so only skip the save without one
+        if self.diff and self.changes == 0 and not self.fingerprint:
+            self.log("Device already configured, nothing to save")
+            if self.key_writes:
+                self.log("Keys were written but not saved, use --fingerprint to save changed keys")
+        else:
+            self.log("Saving mac settings")
+            self.set_confirm('mac save')
+
+    def run(self):
+        self.identify()
+        if self.is_configured():
+            self.log("Configuration fingerprint matches, nothing to do")
+            return
+        self.clear_fingerprint()
+        self.configure_auth()
+        self.configure_channels()
+        self.save()
+        self.store_fingerprint()
+
+
+def open_stik(port, debug=False):
+    reader = ReaderThread(serial.Serial(resolve(port), baudrate=57600), LoStik)
+    reader.start()
+    transport, stik = reader.connect()
+    stik.debug = debug
+    return reader, stik
+
+
+def configure(args, config):
+    reader, stik = open_stik(args.port, args.debug)
+
+    def update_progress(i, ch_count):
+        printProgressBar(i, ch_count, "Channels")
+        if args.debug:
+            print() # extra newline for progress bar
+
+    provisioner = Provisioner(stik, config, args.diff, progress=update_progress,
+                              fingerprint=args.fingerprint)
+    try:
+        provisioner.run()
+    except CommandTimeout:
+        if provisioner.verinfo is not None:
+            raise
+        print("Timeout connecting to device")
+    finally:
+        reader.close()
+
+
+def find_ports(patterns):
+    """
+    Expand a comma separated list of ports, globs and hweuis, 'auto' finds
+    LoStiks by USB id. Returns the ports and {pattern: error} for the
+    hweuis that could not be found.
+    """
+    ports = []
+    errors = {}
+    for pattern in patterns.split(','):
+        pattern = pattern.strip()
+        if pattern == 'auto':
+            matches = candidate_ports()
+        else:
+            try:
+                matches = sorted(glob.glob(pattern)) or [resolve(pattern)]
+            except serial.SerialException as e:
+                errors[pattern] = str(e)
+                continue
+        ports.extend(p for p in matches if p not in ports)
+    return ports, errors
+
+
+class FleetProgress(object):
+    """One progress bar per device, redrawn in place"""
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.state = dict((port, (0, 1)) for port in ports)
+        self.width = max(len(port) for port in ports)
+        self.lock = threading.Lock()
+        self.drawn = False
+
+    def update(self, port, i, total):
+        with self.lock:
+            self.state[port] = (i, total)
+            if self.drawn:
+                sys.stdout.write('\x1b[%dA' % len(self.ports))
+            for p in self.ports:
+                i, total = self.state[p]
+                printProgressBar(i, total, p.ljust(self.width), length=50)
+                if i != total:
+                    print()
+            sys.stdout.flush()
+            self.drawn = True
+
+
+def provision_device(port, config, args, progress):
+    start = time.time()
+    report = {'port': port, 'log': []}
+    try:
+        reader, stik = open_stik(port)
+    except serial.SerialException as e:
+        report['error'] = str(e)
+        return report
+    try:
+        provisioner = Provisioner(stik, config, args.diff, log=report['log'].append,
+                                  progress=lambda i, total: progress.update(port, i, total),
+                                  fingerprint=args.fingerprint)
+        provisioner.run()
+        report['sku'] = provisioner.sku
+        report['changes'] = provisioner.changes
+    except Exception as e:
+        report['error'] = str(e)
+    finally:
+        reader.close()
+        report['seconds'] = time.time() - start
+    return report
+
+
+def configure_fleet(args, config):
+    ports, errors = find_ports(args.port)
+    if not ports and not errors:
+        print("No devices found")
+        exit(1)
+
+    reports = []
+    if ports:
+        progress = FleetProgress(ports)
+        progress.update(ports[0], 0, 1)
+        with ThreadPoolExecutor(max_workers=args.workers or len(ports)) as pool:
+            reports = list(pool.map(lambda port: provision_device(port, config, args, progress), ports))
+    reports.extend({'port': pattern, 'error': error, 'log': []} for pattern, error in errors.items())
+
+    print()
+    failures = [r for r in reports if 'error' in r]
+    for report in reports:
+        if 'error' in report:
+            print("%s: FAILED %s" % (report['port'], report['error']))
+        else:
+            print("%s: %s, %d changes in %.1fs" % (report['port'], report['sku'],
+                                                  report['changes'], report['seconds']))
+        if args.debug:
+            for line in report['log']:
+                print("    %s" % line)
+    print("%d devices configured, %d failed" % (len(reports) - len(failures), len(failures)))
+    if failures:
+        exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Configure LoStik device')
+    parser.add_argument('port', help="Serial port of LoStik. With --fleet a comma separated list of ports "
+                        "and globs, e.g. '/dev/ttyUSB*', or 'auto' to find connected LoStiks")
+    parser.add_argument('config', help="Configuration File")
+    parser.add_argument('--debug', '-d', help="Print debug output", action='store_const', const=True, default=False)
+    parser.add_argument('--diff', help="Read the device settings first and only send the commands needed to change them. "
+                        "mac save is skipped when nothing that can be read back changed; keys cannot, "
+                        "use --fingerprint to save changed keys.",
+                        action='store_const', const=True, default=False)
+    parser.add_argument('--fingerprint', help="Store a hash of the configuration in the device NVM and skip "
+                        "devices that already hold it", action='store_const', const=True, default=False)
+    parser.add_argument('--fleet', '-f', help="Configure every device matching port in parallel",
+                        action='store_const', const=True, default=False)
+    parser.add_argument('--workers', '-w', help="Devices to configure at once in fleet mode (default: all)",
+                        type=int, default=0)
+
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    if args.fleet:
+        configure_fleet(args, config)
+    else:
+        configure(args, config)
 
-    config_status = config_fields[1].replace('"', '').strip()
-    set_confirm('mac set ch status %d %s' % (ch_id, config_status))
-    update_progress()
 
-print("Saving mac settings")
-set_confirm('mac save')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
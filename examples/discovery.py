@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Find LoStiks and remember which is which.
+
+discover() probes candidate serial ports in parallel with 'sys get ver' and
+'sys get hweui' and tells RN2903 from RN2483 modules. What it finds is cached
+in a JSON file keyed by the USB serial number of the port, or its USB
+location or path when the converter has no serial number, so later runs can
+turn "the stick with hweui X" into a port without opening any port.
+
+    port = resolve('0004A30B001A2B3C')    # hweui -> '/dev/ttyUSB1'
+    port = resolve('auto')                # the only LoStik connected
+    for device in discover():
+        print(device.port, device.sku, device.hweui)
+
+Scripts that take a port accept an hweui or 'auto' through resolve(). Run as
+a script to probe and list devices:
+
+    ./discovery.py
+    ./discovery.py /dev/pts/3 /dev/pts/4
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+from serial.threaded import ReaderThread
+from serial.tools.list_ports import comports
+
+from lostik import BAUDRATE, CommandError, LoStik, wait_for_module
+
+# USB IDs of the CH340 serial converter on the LoStik
+LOSTIK_USB_IDS = ((0x1A86, 0x7523),)
+
+SKUS = ('RN2903', 'RN2483')
+
+CACHE_PATH = os.environ.get(
+    'LOSTIK_DEVICE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'lostik', 'devices.json'))
+
+HWEUI = re.compile(r'^[0-9A-Fa-f]{16}$')
+
+Device = namedtuple('Device', 'port sku version hweui serial_number location')
+
+
+def candidate_ports(all_ports=False):
+    """Serial ports with a LoStik's USB IDs, or every serial port"""
+    return sorted(p.device for p in comports() if all_ports or (p.vid, p.pid) in LOSTIK_USB_IDS)
+
+
+def usb_info(port):
+    """(serial number, location) of a USB serial port, Nones for other ports"""
+    for info in comports():
+        if info.device == port:
+            return info.serial_number, info.location
+    return None, None
+
+
+def sku_of(version):
+    """The SKU in a 'sys get ver' reply, None for other devices"""
+    for sku in SKUS:
+        if sku in version:
+            return sku
+    return None
+
+
+def probe(port):
+    """Identify the module on port, None if it isn't an RN2xx3"""
+    try:
+        reader = ReaderThread(serial.Serial(port, baudrate=BAUDRATE), LoStik)
+    except serial.SerialException:
+        return None
+    reader.start()
+    try:
+        _, stik = reader.connect()
+        version = wait_for_module(stik)
+        sku = sku_of(version)
+        if sku is None:
+            return None
+        hweui = stik.command('sys get hweui').upper()
+    except CommandError:
+        return None
+    finally:
+        reader.close()
+    serial_number, location = usb_info(port)
+    return Device(port, sku, version, hweui, serial_number, location)
+
+
+def hweui_at(port):
+    """hweui of the module on port, None if it can't be read"""
+    try:
+        reader = ReaderThread(serial.Serial(port, baudrate=BAUDRATE), LoStik)
+    except serial.SerialException:
+        return None
+    reader.start()
+    try:
+        _, stik = reader.connect()
+        return stik.command('sys get hweui').upper()
+    except CommandError:
+        return None
+    finally:
+        reader.close()
+
+
+def cache_key(device):
+    if device.serial_number:
+        return 'serial:%s' % device.serial_number
+    if device.location:
+        return 'location:%s' % device.location
+    return 'port:%s' % device.port
+
+
+class DeviceCache(object):
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def update(self, devices):
+        for device in devices:
+            # forget where the device was before
+            for key, entry in list(self.entries.items()):
+                if entry['hweui'] == device.hweui:
+                    del self.entries[key]
+            entry = device._asdict()
+            entry['seen'] = time.time()
+            self.entries[cache_key(device)] = entry
+
+    def connected(self):
+        """Cached devices that are connected now by port, without opening any port"""
+        infos = comports()
+        ports = {}
+        for entry in self.entries.values():
+            if entry.get('serial_number'):
+                port = next((i.device for i in infos if i.serial_number == entry['serial_number']), None)
+            elif entry.get('location'):
+                port = next((i.device for i in infos if i.location == entry['location']), None)
+            else:
+                port = entry['port'] if os.path.exists(entry['port']) else None
+            if port is not None:
+                ports[port] = entry
+        return ports
+
+    def find(self, hweui):
+        """Port of the device with hweui, None if unknown or not connected"""
+        for port, entry in self.connected().items():
+            if entry['hweui'] == hweui.upper():
+                return port
+        return None
+
+
+def discover(ports=None, workers=None, cache=None):
+    """Probe ports (default: all LoStik ports) in parallel, returns the Devices found"""
+    if ports is None:
+        ports = candidate_ports()
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or len(ports)) as pool:
+        devices = [device for device in pool.map(probe, ports) if device is not None]
+    if cache is not None:
+        cache.update(devices)
+        cache.save()
+    return devices
+
+
+def resolve(spec, cache=None):
+    """
+    Port for spec: an hweui (from the cache, probing on a miss or when the
+    stick on the cached port has another hweui, e.g. after sticks were
+    swapped between USB sockets), 'auto' for the one LoStik connected,
+    anything else is taken as a port.
+    """
+    if spec != 'auto' and not (HWEUI.match(spec) and not os.path.exists(spec)):
+        return spec
+    if cache is None:
+        cache = DeviceCache()
+    if spec != 'auto':
+        port = cache.find(spec)
+        if port is not None and hweui_at(port) == spec.upper():
+            return port
+    devices = discover(cache=cache)
+    if spec == 'auto':
+        if len(devices) != 1:
+            raise serial.SerialException('auto: found %d LoStiks, give a port or hweui' % len(devices))
+        return devices[0].port
+    for device in devices:
+        if device.hweui == spec.upper():
+            return device.port
+    raise serial.SerialException('no LoStik with hweui %s' % spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find connected LoStiks')
+    parser.add_argument('ports', nargs='*', help="Ports to probe, default: all ports with a LoStik's USB IDs")
+    parser.add_argument('--all', '-a', help="Probe every serial port", action='store_true')
+    parser.add_argument('--resolve', '-r', help="Print the port of the LoStik with this hweui")
+    parser.add_argument('--cache', help="Device cache file", default=CACHE_PATH)
+    args = parser.parse_args()
+
+    cache = DeviceCache(args.cache)
+    if args.resolve:
+        try:
+            print(resolve(args.resolve, cache))
+        except serial.SerialException as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        return
+    devices = discover(args.ports or candidate_ports(args.all), cache=cache)
+    for device in devices:
+        print('%-16s %s %s  %s' % (device.port, device.sku, device.hweui, device.version))
+    if not devices:
+        print("No devices found", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Duty-cycle bookkeeping for LoRaWAN uplinks.
+
+The RN2483 refuses an uplink with ``no_free_ch`` while the duty cycle of
+every usable channel is exhausted, and the regional sub-band limits
+(e.g. 1% in 868.0-868.6 MHz) apply on top of the per-channel ``dcycle``
+setting. DutyCycleLedger mirrors both from the channel table and the
+airtime of every uplink, so a sender can sleep until the earliest legal
+moment instead of polling the module.
+
+    ledger = DutyCycleLedger.from_device(stik)
+    airtime = ledger.airtime(MAC_OVERHEAD + len(payload))
+    time.sleep(ledger.wait(airtime))
+    stik.transact('mac tx uncnf 1 %s' % payload.hex())
+    ledger.record(airtime)
+
+The module picks a channel at random among the free ones and doesn't say
+which, so the ledger assumes the one that frees up first. A ``no_free_ch``
+reply means the guess was wrong; ``defer`` holds off every channel for a
+while.
+"""
+import time
+from collections import deque
+
+from lostik import CommandError, mac_airtime
+
+# Regional sub-bands: (lowest Hz, highest Hz, maximum duty cycle)
+BANDS = {
+    'RN2483': (
+        (863000000, 865000000, .001),
+        (865000000, 868000000, .01),
+        (868000000, 868600000, .01),
+        (868700000, 869200000, .001),
+        (869400000, 869650000, .1),
+        (869700000, 870000000, .01),
+    ),
+    # US902-928 limits dwell time rather than duty cycle
+    'RN2903': (),
+}
+
+# Band duty cycles are averaged over this many seconds
+BAND_WINDOW = 3600.0
+
+# Seconds to hold off after the module unexpectedly answers no_free_ch
+NO_FREE_CH_BACKOFF = 5.0
+
+
+class Channel(object):
+
+    def __init__(self, index, freq, dcycle=0, drrange=(0, 15), band=None):
+        self.index = index
+        self.freq = freq
+        self.dcycle = dcycle
+        self.drrange = drrange
+        self.band = band
+        self.free_at = 0.0
+
+    def usable(self, dr):
+        return self.drrange[0] <= dr <= self.drrange[1]
+
+
+class Band(object):
+
+    def __init__(self, low, high, duty, window=BAND_WINDOW):
+        self.low = low
+        self.high = high
+        self.duty = duty
+        self.window = window
+        self.history = deque()
+
+    def contains(self, freq):
+        return self.low <= freq < self.high
+
+    def ready(self, airtime, now):
+        """Earliest time from now that airtime fits in the band's budget"""
+        budget = self.duty * self.window - airtime
+        used = sum(spent for start, spent in self.history if start > now - self.window)
+        for start, spent in self.history:
+            if used <= budget:
+                break
+            if start <= now - self.window:
+                continue
+            # wait for this transmission to leave the window
+            now = start + self.window
+            used -= spent
+        return now
+
+    def record(self, airtime, now):
+        self.history.append((now, airtime))
+        while self.history and self.history[0][0] <= now - self.window:
+            self.history.popleft()
+
+
+def read_channels(stik, sku):
+    """The enabled channels of the module"""
+    channels = []
+    # the RN2903 has no duty cycle limits, skip reading its 72 channels
+    for ch in range(0 if sku == 'RN2903' else 16):
+        if stik.command('mac get ch status %d' % ch) != 'on':
+            continue
+        freq = int(stik.command('mac get ch freq %d' % ch))
+        drrange = tuple(int(dr) for dr in stik.command('mac get ch drrange %d' % ch).split())
+        dcycle = int(stik.command('mac get ch dcycle %d' % ch))
+        channels.append(Channel(ch, freq, dcycle, drrange))
+    return channels
+
+
+class DutyCycleLedger(object):
+
+    def __init__(self, sku, channels, bands=(), dr=0, clock=time.monotonic):
+        self.sku = sku
+        self.bands = [Band(*band) for band in bands]
+        self.channels = channels
+        for channel in channels:
+            channel.band = self._band(channel.freq)
+        self.dr = dr
+        self.clock = clock
+
+    @classmethod
+    def from_device(cls, stik, sku=None):
+        """Build a ledger from the enabled channels of the module"""
+        if sku is None:
+            sku = stik.command('sys get ver').split(' ', 1)[0]
+        ledger = cls(sku, read_channels(stik, sku), BANDS.get(sku, ()))
+        ledger.update_dr(stik)
+        return ledger
+
+    def refresh(self, stik):
+        """
+        Re-read the channel table and data rate, e.g. after a join accept
+        added channels, keeping the airtime already spent on each channel
+        and band
+        """
+        spent = dict(((c.index, c.freq), c.free_at) for c in self.channels)
+        self.channels = read_channels(stik, self.sku)
+        for channel in self.channels:
+            channel.band = self._band(channel.freq)
+            channel.free_at = spent.get((channel.index, channel.freq), 0.0)
+        self.update_dr(stik)
+
+    def _band(self, freq):
+        return next((band for band in self.bands if band.contains(freq)), None)
+
+    def update_dr(self, stik):
+        """Re-read the data rate, which ADR may have changed"""
+        dr = stik.command('mac get dr')
+        try:
+            self.dr = int(dr)
+        except ValueError:
+            raise CommandError('mac get dr', dr)
+        return self.dr
+
+    def airtime(self, length):
+        """Time on air of a length byte PHY payload at the current data rate"""
+        return mac_airtime(self.sku, self.dr, length)
+
+    def _ready(self, channel, airtime, now):
+        ready = max(now, channel.free_at)
+        if channel.band is not None:
+            ready = max(ready, channel.band.ready(airtime, ready))
+        return ready
+
+    def _best(self, airtime, now):
+        best = None
+        for channel in self.channels:
+            if not channel.usable(self.dr):
+                continue
+            ready = self._ready(channel, airtime, now)
+            if best is None or ready < best[0]:
+                best = (ready, channel)
+        return best
+
+    def earliest(self, airtime):
+        """Clock time at which an uplink of airtime seconds is allowed"""
+        now = self.clock()
+        best = self._best(airtime, now)
+        return now if best is None else best[0]
+
+    def wait(self, airtime):
+        """Seconds to wait before an uplink of airtime seconds is allowed"""
+        return max(0.0, self.earliest(airtime) - self.clock())
+
+    def retransmit_wait(self, airtime):
+        """
+        Longest the duty cycle can hold back a retransmission of an uplink of
+        airtime seconds, e.g. of a confirmed uplink that wasn't acknowledged
+        """
+        usable = [channel for channel in self.channels if channel.usable(self.dr)]
+        waits = [airtime * (channel.dcycle + 1) for channel in usable]
+        waits.extend(airtime / band.duty for band in set(c.band for c in usable if c.band is not None))
+        return max(waits or [0.0])
+
+    def record(self, airtime):
+        """Account for an uplink the module accepted"""
+        now = self.clock()
+        best = self._best(airtime, now)
+        if best is None:
+            return None
+        channel = best[1]
+        # dcycle X allows 1/(X+1) of the time on the channel
+        channel.free_at = now + airtime * (channel.dcycle + 1)
+        if channel.band is not None:
+            channel.band.record(airtime, now)
+        return channel
+
+    def defer(self, seconds=NO_FREE_CH_BACKOFF):
+        """Hold off every channel, after the module disagreed with the ledger"""
+        until = self.clock() + seconds
+        for channel in self.channels:
+            channel.free_at = max(channel.free_at, until)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Link test sweep between two LoStiks in radio mode.
+
+One stick sends and the other receives. For every combination of the
+spreading factors, bandwidths, coding rates and power levels given, both
+sticks are configured, the sender transmits --count numbered packets and the
+receiver listens for each one in a window sized to its time on air. The
+result is a table of packet error rate, RSSI and SNR per test point, with
+the raw LoRa bitrate and the goodput (payload bits delivered per second of
+airtime), and the fastest point whose PER is below --max-per.
+
+The points are visited in a reflected Gray code order, so consecutive points
+differ in a single setting, and 'radio set' commands for settings a stick
+already has are skipped.
+
+    ./link_test.py /dev/ttyUSB0 /dev/ttyUSB1 --sf 7,8,9,10 --pwr 2,10,20 -n 50
+    ./link_test.py /dev/ttyUSB0 /dev/ttyUSB1 --bw 125,500 --json > site.json
+"""
+import argparse
+import itertools
+import json
+import struct
+import sys
+from collections import namedtuple
+
+import serial
+from serial.threaded import ReaderThread
+
+from lostik import (DEFAULT_TIMEOUT, CommandError, CommandTimeout, LoStik, get_int, radio_settings,
+                    rx_symbols, time_on_air, wait_for_module)
+
+# Test point index and packet number, padded to --size
+PACKET = struct.Struct('>HH')
+
+TestPoint = namedtuple('TestPoint', 'freq sf bw cr pwr')
+
+# radio set commands needed to change a setting: one per stick, the
+# receiver's power doesn't matter
+SETTING_COST = {'freq': 2, 'sf': 2, 'bw': 2, 'cr': 2, 'pwr': 1}
+
+
+def bitrate(sf, bw, cr):
+    """Raw LoRa bitrate in bits/s, bw in kHz and cr 1-4 for 4/5-4/8"""
+    return sf * bw * 1000.0 / 2 ** sf * 4 / (4 + cr)
+
+
+def sweep_points(grid):
+    """Points of grid ({setting: values}) in nested loop order"""
+    return [TestPoint(*point) for point in itertools.product(*(grid[name] for name in TestPoint._fields))]
+
+
+def plan_sweep(grid, current=None):
+    """
+    Points of grid ({setting: values}) in a reflected Gray code walk:
+    consecutive points differ in exactly one setting, and the settings that
+    cost the most to change are the outermost loops so they change least
+    often. Each setting starts from its value in current where it can.
+    """
+    current = current or {}
+    names = sorted(TestPoint._fields, key=lambda name: -SETTING_COST[name])
+    dims = []
+    for name in names:
+        values = list(grid[name])
+        if name in current and current[name] in values:
+            start = values.index(current[name])
+            values = values[start:] + values[:start]
+        dims.append(values)
+    walk = [()]
+    for values in reversed(dims):
+        walk = [(value,) + rest
+                for i, value in enumerate(values)
+                for rest in (walk if i % 2 == 0 else walk[::-1])]
+    return [TestPoint(**dict(zip(names, point))) for point in walk]
+
+
+class Result(object):
+
+    def __init__(self, point, size):
+        self.point = point
+        self.size = size
+        self.sent = 0
+        self.received = set()
+        self.rssi = []
+        self.snr = []
+        self.airtime = None
+
+    @property
+    def per(self):
+        return 1 - len(self.received) / float(self.sent) if self.sent else None
+
+    @property
+    def bitrate(self):
+        return bitrate(self.point.sf, self.point.bw, self.point.cr)
+
+    @property
+    def goodput(self):
+        """Payload bits/s delivered when sending back to back"""
+        if not self.sent or not self.airtime:
+            return 0.0
+        return (1 - self.per) * self.size * 8 / self.airtime
+
+    def report(self):
+        return {
+            'freq': self.point.freq,
+            'sf': self.point.sf,
+            'bw': self.point.bw,
+            'cr': '4/%d' % (self.point.cr + 4),
+            'pwr': self.point.pwr,
+            'sent': self.sent,
+            'received': len(self.received),
+            'per': self.per,
+            'rssi': summary(self.rssi),
+            'snr': summary(self.snr),
+            'airtime': self.airtime,
+            'bitrate': self.bitrate,
+            'goodput': self.goodput,
+        }
+
+
+def summary(values):
+    if not values:
+        return None
+    return {'mean': sum(values) / float(len(values)), 'min': min(values), 'max': max(values)}
+
+
+def radio_values(point):
+    """radio set arguments for a test point, except the sender's power"""
+    values = [('sf', 'sf%d' % point.sf), ('bw', point.bw), ('cr', '4/%d' % (point.cr + 4))]
+    if point.freq is not None:
+        values.insert(0, ('freq', point.freq))
+    return values
+
+
+def configure(sender, receiver, point):
+    """Apply a test point to both sticks, returns the number of radio set commands sent"""
+    sent = 0
+    for stik in (sender, receiver):
+        for key, value in radio_values(point):
+            sent += stik.radio_set(key, value)
+    sent += sender.radio_set('pwr', point.pwr)
+    return sent
+
+
+def current_point(stik):
+    """Test point the stick is set to"""
+    return {
+        'freq': int(stik.radio_get('freq')),
+        'sf': int(stik.radio_get('sf')[2:]),
+        'bw': int(stik.radio_get('bw')),
+        'cr': int(stik.radio_get('cr').split('/')[1]) - 4,
+        'pwr': int(stik.radio_get('pwr')),
+    }
+
+
+def run_point(sender, receiver, index, point, count, size, margin):
+    """Send count packets at point, returns its Result"""
+    result = Result(point, size)
+    result.airtime = time_on_air(length=size, **radio_settings(sender))
+    window = rx_symbols(point.sf, point.bw, result.airtime + margin)
+    timeout = window * 2 ** point.sf / (point.bw * 1000.0) + DEFAULT_TIMEOUT
+    for seq in range(count):
+        payload = PACKET.pack(index, seq).ljust(size, b'\0')
+        receiver.clear_events()
+        receiver.command_ok('radio rx %d' % window)
+        try:
+            sender.transact('radio tx %s' % payload.hex())
+        except CommandError as e:
+            print("%s: sender answered %s" % (format_point(point), e.response), file=sys.stderr)
+        result.sent += 1
+        try:
+            line = receiver.wait_event(timeout, 'radio rx')
+        except CommandTimeout:
+            continue
+        words = line.split()
+        if words[0] != 'radio_rx' or len(words) < 2:
+            continue
+        try:
+            frame = bytes.fromhex(words[1])
+        except ValueError:
+            continue
+        if len(frame) < PACKET.size or PACKET.unpack_from(frame)[0] != index:
+            continue
+        result.received.add(PACKET.unpack_from(frame)[1])
+        rssi = get_int(receiver, 'radio get rssi')
+        if rssi is not None:
+            result.rssi.append(rssi)
+        snr = get_int(receiver, 'radio get snr')
+        if snr is not None:
+            result.snr.append(snr)
+    return result
+
+
+def format_point(point):
+    text = 'SF%d BW%d CR4/%d %+ddBm' % (point.sf, point.bw, point.cr + 4, point.pwr)
+    if point.freq is not None:
+        text = '%d %s' % (point.freq, text)
+    return text
+
+
+def best(reports, max_per):
+    """Fastest reliable point, the lowest power among equally fast ones"""
+    reliable = [r for r in reports if r['per'] is not None and r['per'] <= max_per]
+    if not reliable:
+        return None
+    return max(reliable, key=lambda r: (r['goodput'], -r['pwr']))
+
+
+def print_report(reports, max_per):
+    print('%-9s %-4s %-4s %-4s %4s %5s %5s %6s %7s %7s %6s %6s %9s %9s' % (
+        'FREQ', 'SF', 'BW', 'CR', 'PWR', 'SENT', 'RECV', 'PER', 'RSSI', 'min', 'SNR', 'min',
+        'BITRATE', 'GOODPUT'))
+    for r in sorted(reports, key=lambda r: (r['freq'] or 0, r['sf'], r['bw'], r['cr'], r['pwr'])):
+        rssi = r['rssi'] or {'mean': float('nan'), 'min': float('nan')}
+        snr = r['snr'] or {'mean': float('nan'), 'min': float('nan')}
+        print('%-9s %-4d %-4d %-4s %4d %5d %5d %5.1f%% %7.1f %7.0f %6.1f %6.0f %9.0f %9.0f' % (
+            r['freq'] or '-', r['sf'], r['bw'], r['cr'], r['pwr'], r['sent'], r['received'], 100 * r['per'],
+            rssi['mean'], rssi['min'], snr['mean'], snr['min'], r['bitrate'], r['goodput']))
+    fastest = best(reports, max_per)
+    if fastest is None:
+        print('No point with PER <= %.0f%%' % (100 * max_per))
+    else:
+        point = TestPoint(fastest['freq'], fastest['sf'], fastest['bw'], int(fastest['cr'][2:]) - 4,
+                          fastest['pwr'])
+        print('Fastest with PER <= %.0f%%: %s, %.0f bit/s goodput' % (
+            100 * max_per, format_point(point), fastest['goodput']))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def cr_list(value):
+    """'4/5,4/8' or '5,8' -> [1, 4]"""
+    return [int(v.split('/')[-1]) - 4 for v in value.split(',') if v]
+
+
+def open_stik(port):
+    reader = ReaderThread(serial.Serial(port, baudrate=57600), LoStik)
+    reader.start()
+    _, stik = reader.connect()
+    wait_for_module(stik)
+    stik.command('mac pause')
+    # the watchdog would end long transmissions and receive windows
+    stik.command_ok('radio set wdt 0')
+    return reader, stik
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep LoRa radio settings between two LoStiks')
+    parser.add_argument('sender', help="Serial port of the sending LoStik")
+    parser.add_argument('receiver', help="Serial port of the receiving LoStik")
+    parser.add_argument('--sf', help="Spreading factors", type=int_list, default=[7, 8, 9, 10, 11, 12])
+    parser.add_argument('--bw', help="Bandwidths in kHz", type=int_list, default=[125])
+    parser.add_argument('--cr', help="Coding rates", type=cr_list, default=[1])
+    parser.add_argument('--pwr', help="Sender power levels in dBm", type=int_list, default=[10])
+    parser.add_argument('--freq', help="Frequencies in Hz, default: leave as is", type=int_list, default=[None])
+    parser.add_argument('--count', '-n', help="Packets per test point", type=int, default=20)
+    parser.add_argument('--size', help="Payload bytes", type=int, default=8)
+    parser.add_argument('--margin', help="Seconds the receive window extends past the time on air",
+                        type=float, default=.2)
+    parser.add_argument('--max-per', help="Highest PER that counts as reliable", type=float, default=.1)
+    parser.add_argument('--order', help="Visit points in Gray code order (planned) or in nested loop order",
+                        choices=('planned', 'grid'), default='planned')
+    parser.add_argument('--json', help="Print JSON instead of a table", action='store_true')
+    args = parser.parse_args()
+    if args.size < PACKET.size:
+        parser.error('--size must be at least %d' % PACKET.size)
+
+    tx_reader, sender = open_stik(args.sender)
+    rx_reader, receiver = open_stik(args.receiver)
+    grid = {'freq': args.freq, 'sf': args.sf, 'bw': args.bw, 'cr': args.cr, 'pwr': args.pwr}
+    if args.order == 'planned':
+        points = plan_sweep(grid, current_point(sender))
+    else:
+        points = sweep_points(grid)
+    reports = []
+    changes = 0
+    try:
+        for index, point in enumerate(points):
+            changes += configure(sender, receiver, point)
+            result = run_point(sender, receiver, index, point, args.count, args.size, args.margin)
+            reports.append(result.report())
+            print('%s: %d/%d received' % (format_point(point), len(result.received), result.sent),
+                  file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tx_reader.close()
+        rx_reader.close()
+    # without the cache every point sets everything on both sticks
+    print('%d radio set commands for %d points, %d without skipping' % (
+        changes, len(reports), len(reports) * (2 * len(radio_values(points[0])) + 1)), file=sys.stderr)
+
+    if args.json:
+        print(json.dumps({'points': reports, 'best': best(reports, args.max_per)}, indent=2))
+    else:
+        print_report(reports, args.max_per)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,23 @@
 ##!/usr/bin/env python3
 import io
+import json
+import os
+import random
+import struct
 import sys
+import threading
 import time
 import datetime
 import argparse
 from enum import IntEnum
-import serial
-from serial.threaded import LineReader, ReaderThread
+from serial.threaded import ReaderThread
+
+from lostik import (LoStik, CommandError, CommandTimeout, DEFAULT_TIMEOUT, JOIN_REQUEST_SIZE, MAC_OVERHEAD,
+                    get_int, max_payload)
+from dutycycle import DutyCycleLedger
+from uplink import UplinkQueue
+import metrics
+import wiretrace
 
 parser = argparse.ArgumentParser(description='Connect to LoRaWAN network')
 parser.add_argument('port', help="Serial port of LoStik")
@@ -22,9 +33,31 @@ parser.add_argument('--appeui', help="App EUI", default="")
 parser.add_argument('--appkey', help="App Key", default="")
 parser.add_argument('--deveui', help="Device EUI", default="")
 
+# join retries
+parser.add_argument('--join-retries', help="Give up after this many join attempts, 0 to keep trying",
+                    type=int, default=5)
+parser.add_argument('--join-backoff', help="Seconds before the first join retry, doubled after each",
+                    type=float, default=5)
+parser.add_argument('--join-backoff-max', help="Longest wait between join attempts",
+                    type=float, default=600)
+parser.add_argument('--join-jitter', help="Wait up to this many seconds before the first join",
+                    type=float, default=0)
+parser.add_argument('--subbands', help="RN2903 sub-bands (1-8) to rotate through on join retries, e.g. 1,2",
+                    default="")
+
+parser.add_argument('--session', '-s', help="File to keep the OTAA session in, '' to always join",
+                    default="lorawan_session.json")
+parser.add_argument('--interval', '-i', help="Minimum seconds between uplinks", type=float, default=10)
+parser.add_argument('--reading-interval', '-r', help="Seconds between sensor readings", type=float, default=10)
+parser.add_argument('--max-latency', '-l', help="Longest a reading waits for an uplink to fill up",
+                    type=float, default=60)
+
+metrics.add_arguments(parser)
+wiretrace.add_arguments(parser)
 args = parser.parse_args()
 
-OTAA_RETRIES = 5
+# Seconds a receive window can stay open for a downlink at the slowest data rate
+RX_WINDOW = 1.0
 
 class MaxRetriesError(Exception):
     pass
@@ -37,28 +70,97 @@ class ConnectionState(IntEnum):
     TO_MANY_RETRIES = 520
 
 
-class PrintLines(LineReader):
+class JoinBackoff(object):
+    """
+    Exponential backoff with full jitter: the n-th wait is uniform in
+    [0, min(cap, base * 2**n)], so devices that failed together spread out
+    instead of retrying in lockstep.
+    """
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt = self.attempt + 1
+        return delay
+
+
+class PrintLines(LoStik):
 
     retries = 0
     state = ConnectionState.CONNECTING
+    ledger = None
+    # send the first uplink of a resumed session confirmed to check it
+    verify_session = False
+
+    subband_status = None
 
     def retry(self, action):
-        if(self.retries >= OTAA_RETRIES):
-            print("Too many retries, exiting")
-            self.state = ConnectionState.TO_MANY_RETRIES
-            return
-        self.retries = self.retries + 1
-        action()
+        """Call action until it returns False, backing off between attempts"""
+        backoff = JoinBackoff(args.join_backoff, args.join_backoff_max)
+        if args.join_jitter:
+            time.sleep(random.uniform(0, args.join_jitter))
+        while True:
+            if args.join_retries and self.retries >= args.join_retries:
+                print("Too many retries, exiting")
+                self.state = ConnectionState.TO_MANY_RETRIES
+                return
+            self.retries = self.retries + 1
+            if not action():
+                return
+            delay = backoff.next()
+            print("Retrying in %.1f s" % delay)
+            time.sleep(delay)
+
+    def use_subband(self, subband):
+        """Enable only the eight 125 kHz channels and the 500 kHz channel of an RN2903 sub-band"""
+        if self.subband_status is None:
+            self.subband_status = {}
+        print("Joining on sub-band %d" % subband)
+        for ch in range(72):
+            if ch < 64:
+                status = "on" if ch // 8 == subband - 1 else "off"
+            else:
+                status = "on" if ch - 64 == subband - 1 else "off"
+            if self.subband_status.get(ch) != status:
+                self.command_ok('mac set ch status %d %s' % (ch, status))
+                self.subband_status[ch] = status
 
     def get_var(self, cmd):
-        self.send_cmd(cmd)
-        return self.transport.serial.readline()
+        return self.send_cmd(cmd)
 
     def join(self):
-        if args.joinmode == "abp":
-            self.join_abp()
+        """Try to join once, returns True if it is worth retrying"""
+        subbands = [int(subband) for subband in args.subbands.split(",") if subband]
+        if subbands and self.ledger.sku == "RN2903":
+            self.use_subband(subbands[(self.retries - 1) % len(subbands)])
+        try:
+            if args.joinmode == "abp":
+                status = self.join_abp()
+            else:
+                status = self.join_otaa()
+        except CommandTimeout as e:
+            # the join accept got lost, or the reply to it
+            print(e)
+            return True
+        except CommandError as e:
+            status = e.response
+            print("STATUS: %s" % status)
+            if status == "no_free_ch":
+                self.ledger.defer()
+        if status == "denied" or status == "no_free_ch" or status == "busy":
+            return True
+        elif status == "accepted":
+            print("UPDATING STATE to connected")
+            self.state = ConnectionState.CONNECTED
+            if args.joinmode != "abp":
+                self.save_session()
         else:
-            self.join_otaa()
+            self.state = ConnectionState.FAILED
+        return False
 
     def join_otaa(self):
         if len(args.appeui):
@@ -67,7 +169,128 @@ class PrintLines(LineReader):
             self.send_cmd('mac set appkey %s' % args.appkey)
         if len(args.deveui):
             self.send_cmd('mac set deveui %s' % args.deveui)
-        self.send_cmd('mac join otaa')
+        self.ledger.update_dr(self)
+        airtime = self.ledger.airtime(JOIN_REQUEST_SIZE)
+        self.wait_duty_cycle(airtime)
+        print('mac join otaa')
+        self.clear_events()
+        self.command_ok('mac join otaa')
+        self.ledger.record(airtime)
+        return self.wait_done('mac join otaa')
+
+    def resume_session(self):
+        """
+        Restore the session of the last OTAA join instead of joining again.
+        The module keeps the session keys from 'mac save', the session file
+        has the frame counters since then.
+        """
+        session = load_session(args.session)
+        if session is None or args.joinmode == "abp":
+            return False
+        if len(args.deveui) and args.deveui.upper() != session['deveui']:
+            return False
+        if (self.command('mac get deveui') != session['deveui']
+                or self.command('mac get devaddr') != session['devaddr']):
+            return False
+        # skip one in case an uplink went out after the counters were stored
+        self.send_cmd('mac set upctr %d' % (session['upctr'] + 1))
+        self.send_cmd('mac set dnctr %d' % session['dnctr'])
+        print('mac join abp')
+        try:
+            status = self.transact('mac join abp')
+        except CommandError as e:
+            status = e.response
+            print("STATUS: %s" % status)
+        if status != "accepted":
+            return False
+        self.state = ConnectionState.CONNECTED
+        self.verify_session = True
+        return True
+
+    def save_session(self):
+        """Save the session keys on the module and the counters locally"""
+        if not args.session:
+            return
+        self.command_ok('mac save')
+        self.store_counters({
+            'deveui': self.command('mac get deveui'),
+            'devaddr': self.command('mac get devaddr'),
+        })
+
+    def store_counters(self, session=None):
+        if not args.session:
+            return
+        if session is None:
+            session = load_session(args.session) or {}
+        session['upctr'] = int(self.command('mac get upctr'))
+        session['dnctr'] = int(self.command('mac get dnctr'))
+        write_session(args.session, session)
+
+    def rejoin(self):
+        print("Session rejected, joining with OTAA")
+        if args.session and os.path.exists(args.session):
+            os.remove(args.session)
+        self.state = ConnectionState.CONNECTING
+        self.retries = 0
+        self.retry(self.join)
+        self.ledger.refresh(self)
+
+    def wait_duty_cycle(self, airtime):
+        wait = self.ledger.wait(airtime)
+        if wait > 0:
+            print("Duty cycle: waiting %.1f s" % wait)
+            time.sleep(wait)
+
+    def uplink_batch(self, port, uplinks):
+        """Send the next batch of readings, as large as the data rate allows"""
+        self.ledger.update_dr(self)
+        # check a resumed session straight away rather than after max latency
+        payload = uplinks.get_batch(max_payload(self.ledger.sku, self.ledger.dr),
+                                    max_latency=0 if self.verify_session else None)
+        if not payload:
+            return None
+        if not self.verify_session:
+            status = self.uplink(port, payload.hex())
+        else:
+            try:
+                status = self.uplink(port, payload.hex(), confirmed=True)
+            except CommandTimeout as e:
+                # an unverified session is no better than a rejected one
+                print(e)
+                status = None
+            if status is None or status == "mac_err":
+                self.rejoin()
+                return status
+            self.verify_session = False
+        self.store_counters()
+        return status
+
+    def confirmed_timeout(self, airtime):
+        """
+        Longest a confirmed uplink can take: the module retransmits it up to
+        retx times, each after the RX2 window and the duty cycle allow
+        """
+        retx = get_int(self, 'mac get retx') or 0
+        rxdelay2 = (get_int(self, 'mac get rxdelay2') or 2000) / 1000.0
+        attempt = airtime + rxdelay2 + RX_WINDOW + self.ledger.retransmit_wait(airtime)
+        return (retx + 1) * attempt + DEFAULT_TIMEOUT
+
+    def uplink(self, port, data, confirmed=False):
+        """Send an uplink once the duty cycle allows it"""
+        airtime = self.ledger.airtime(MAC_OVERHEAD + len(data) // 2)
+        second_timeout = self.confirmed_timeout(airtime) if confirmed else False
+        self.wait_duty_cycle(airtime)
+        txmsg = "mac tx %s %d %s" % ("cnf" if confirmed else "uncnf", port, data)
+        print(txmsg)
+        self.clear_events()
+        try:
+            self.command_ok(txmsg)
+        except CommandError as e:
+            if e.response == "no_free_ch":
+                self.ledger.defer()
+            raise
+        self.ledger.record(airtime)
+        return self.wait_done(txmsg, second_timeout)
 
     def join_abp(self):
             if len(args.devaddr):
@@ -76,26 +299,18 @@ class PrintLines(LineReader):
                 self.send_cmd('mac set appskey %s' % args.appskey) 
             if len(args.nwkskey):
                 self.send_cmd('mac set nwkskey %s' % args.nwkskey)
-            self.send_cmd('mac join abp')
+            print('mac join abp')
+            return self.transact('mac join abp')
 
     def connection_made(self, transport):
         """
         Fires when connection is made to serial port device
         """
+        super(PrintLines, self).connection_made(transport)
         print("Connection to LoStik established")
-        self.transport = transport
-        self.retry(self.join)
 
-    def handle_line(self, data):
-        # if data == "ok" or data == 'busy':
-        #     return
+    def handle_event(self, data):
         print("STATUS: %s" % data)
-        if data.strip() == "denied" or data.strip() == "no_free_ch":
-            print("Retrying OTAA connection")
-            self.retry(self.join)
-        elif data.strip() == "accepted":
-            print("UPDATING STATE to connected")
-            self.state = ConnectionState.CONNECTED
 
     def connection_lost(self, exc):
         """
@@ -105,18 +320,52 @@ class PrintLines(LineReader):
             print(exc)
         print("Lost connection to serial device")
 
-    def send_cmd(self, cmd, delay=.5):
+    def send_cmd(self, cmd):
         print(cmd)
-        self.transport.write(('%s\r\n' % cmd).encode('UTF-8'))
-        time.sleep(delay)
+        return self.command(cmd)
+
+
+def load_session(path):
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_session(path, session):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(session, f)
+    os.replace(tmp, path)
+
+
+def read_sensor(uplinks):
+    """Stand-in sensor, queues a 4 byte timestamp every reading interval"""
+    while True:
+        uplinks.put(struct.pack('>I', int(time.time())))
+        time.sleep(args.reading_interval)
 
 
-ser = serial.Serial(args.port, baudrate=57600)
+ser = wiretrace.open_port(args, args.port)
 with ReaderThread(ser, PrintLines) as protocol:
+    protocol.metrics = metrics.from_args(args)
+    protocol.ledger = DutyCycleLedger.from_device(protocol)
+    if not protocol.resume_session():
+        protocol.retry(protocol.join)
+        # the network may have added channels in the join accept
+        protocol.ledger.refresh(protocol)
+    uplinks = UplinkQueue(args.max_latency)
+    sensor = threading.Thread(target=read_sensor, args=(uplinks,))
+    sensor.daemon = True
+    sensor.start()
     while protocol.state < ConnectionState.FAILED:
-        if protocol.state != ConnectionState.CONNECTED:
-            time.sleep(1)
-            continue
-        protocol.send_cmd("mac tx uncnf 1 %d" % int(time.time()))
-        time.sleep(10)
-    exit(protocol.state)
\ No newline at end of file
+        start = time.time()
+        try:
+            protocol.uplink_batch(1, uplinks)
+        except CommandError as e:
+            print("STATUS: %s" % e.response)
+        time.sleep(max(0, args.interval - (time.time() - start)))
+    exit(protocol.state)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for talking to a LoStik (RN2903 / RN2483 module).
+
+The module answers every command with exactly one line (``ok``,
+``invalid_param``, ``busy``, a value, ...). A handful of commands
+(``mac tx``, ``mac join``, ``radio tx``, ``radio rx``) send a second,
+asynchronous line once the radio operation has finished. ``LoStik`` matches
+replies to the command that caused them so callers can continue the moment
+the module answers instead of sleeping for a fixed delay.
+
+    ser = serial.Serial(port, baudrate=57600)
+    with ReaderThread(ser, LoStik) as stik:
+        print(stik.command('sys get ver'))
+        stik.command_ok('mac pause')
+"""
+import math
+import queue
+import threading
+import time
+
+from serial.threaded import LineReader
+
+BAUDRATE = 57600
+
+# User EEPROM of the module, addressed one byte at a time
+NVM_START = 0x300
+NVM_END = 0x3FF
+
+# Data rate -> (spreading factor, bandwidth in kHz)
+DATA_RATES = {
+    'RN2903': {0: (10, 125), 1: (9, 125), 2: (8, 125), 3: (7, 125), 4: (8, 500)},
+    'RN2483': {0: (12, 125), 1: (11, 125), 2: (10, 125), 3: (9, 125),
+               4: (8, 125), 5: (7, 125), 6: (7, 250)},
+}
+
+# Data rate -> largest mac tx payload in bytes (LoRaWAN regional parameters)
+MAX_PAYLOAD = {
+    'RN2903': {0: 11, 1: 53, 2: 125, 3: 242, 4: 242},
+    'RN2483': {0: 51, 1: 51, 2: 51, 3: 115, 4: 222, 5: 222, 6: 222},
+}
+
+# Longest 'radio rx' window in symbols
+MAX_RX_SYMBOLS = 65535
+
+# LoRaWAN header, port and MIC added to every mac tx payload
+MAC_OVERHEAD = 13
+# PHY payload of a join request
+JOIN_REQUEST_SIZE = 23
+
+# Seconds to wait for the first reply of a command
+DEFAULT_TIMEOUT = 2.0
+COMMAND_TIMEOUTS = {
+    'sys reset': 5.0,
+    'sys factoryRESET': 5.0,
+    'mac save': 5.0,
+}
+
+# Seconds to wait for the second reply of commands that have one
+# (None waits forever, used for 'radio rx 0')
+ASYNC_TIMEOUTS = {
+    'mac join': 20.0,
+    'mac tx': 30.0,
+    'radio tx': 20.0,
+    'radio rx': None,
+}
+
+# First word of lines that are only ever sent as second replies
+ASYNC_REPLIES = (
+    'accepted',
+    'denied',
+    'mac_tx_ok',
+    'mac_rx',
+    'mac_err',
+    'radio_tx_ok',
+    'radio_rx',
+    'radio_err',
+)
+
+# Replies that mean a command failed
+ERROR_REPLIES = (
+    'invalid_param',
+    'err',
+    'busy',
+    'not_joined',
+    'no_free_ch',
+    'silent',
+    'frame_counter_err_rejoin_needed',
+    'mac_paused',
+    'invalid_data_len',
+    'keys_not_init',
+    'denied',
+    'mac_err',
+    'radio_err',
+)
+
+# Radio settings LoStik.radio_get can answer from its cache
+RADIO_SETTINGS = (
+    'mod', 'freq', 'pwr', 'sf', 'afcbw', 'rxbw', 'bitrate', 'fdev',
+    'prlen', 'crc', 'iqi', 'cr', 'wdt', 'sync', 'bw',
+)
+
+# Commands after which the radio settings are unknown, LoRaWAN operations
+# set up the radio themselves
+RADIO_RESETS = (
+    'sys reset',
+    'sys factoryRESET',
+    'mac join',
+    'mac tx',
+)
+
+
+class CommandError(Exception):
+    """The module rejected a command"""
+
+    def __init__(self, cmd, response):
+        super(CommandError, self).__init__(
+            "Error in command: %s\r\n Response: %s" % (cmd, response))
+        self.cmd = cmd
+        self.response = response
+
+
+class CommandTimeout(CommandError):
+    """The module did not answer in time"""
+
+    def __init__(self, cmd):
+        super(CommandTimeout, self).__init__(cmd, None)
+        self.args = ("Timeout waiting for response to: %s" % cmd,)
+
+
+def command_prefix(cmd, table):
+    """Return the longest key in table whose words cmd starts with, or None"""
+    match = None
+    for prefix in table:
+        if ((cmd == prefix or cmd.startswith(prefix + ' '))
+                and (match is None or len(prefix) > len(match))):
+            match = prefix
+    return match
+
+
+def command_timeout(cmd):
+    prefix = command_prefix(cmd, COMMAND_TIMEOUTS)
+    return COMMAND_TIMEOUTS[prefix] if prefix else DEFAULT_TIMEOUT
+
+
+def has_second_reply(cmd):
+    return command_prefix(cmd, ASYNC_TIMEOUTS) is not None
+
+
+def async_timeout(cmd):
+    prefix = command_prefix(cmd, ASYNC_TIMEOUTS)
+    if prefix is None:
+        return DEFAULT_TIMEOUT
+    if prefix == 'radio rx':
+        # 'radio rx <n>' listens for n symbols, 0 means until the watchdog fires
+        return None
+    return ASYNC_TIMEOUTS[prefix]
+
+
+def is_async_reply(line):
+    return line.split(' ', 1)[0] in ASYNC_REPLIES
+
+
+def time_on_air(sf, bw, cr, prlen, crc, length):
+    """
+    LoRa time on air in seconds of a length byte payload, see Semtech
+    AN1200.13. bw is in kHz, cr is 1-4 for 4/5-4/8 and crc is 1 or 0. The
+    RN2xx3 always sends an explicit header and uses low data rate
+    optimization when a symbol is longer than 16 ms.
+    """
+    tsym = (2 ** sf) / (bw * 1000.0)
+    de = 1 if tsym > 0.016 else 0
+    payload = 8 + max(math.ceil(
+        (8 * length - 4 * sf + 28 + 16 * crc) / (4.0 * (sf - 2 * de))) * (cr + 4), 0)
+    return (prlen + 4.25 + payload) * tsym
+
+
+def rx_symbols(sf, bw, seconds):
+    """'radio rx' window of at least seconds in LoRa symbols, bw in kHz"""
+    return min(MAX_RX_SYMBOLS, max(1, int(math.ceil(seconds * bw * 1000.0 / 2 ** sf))))
+
+
+class LoStik(LineReader):
+    """
+    LineReader that pairs every line from the module with the command that
+    caused it. Lines that arrive while no command is outstanding (second
+    replies, received frames) are handed to handle_event and queued for
+    wait_event.
+
+    command() and friends block until the reply arrives, so they must not be
+    called from the reader thread (i.e. from handle_event).
+
+    Set metrics to a metrics.Metrics to record command latencies and replies.
+
+    Radio settings seen in 'radio set' and 'radio get' commands are cached in
+    radio_cache, so radio_set() can skip commands that would change nothing.
+    """
+
+    def __init__(self):
+        super(LoStik, self).__init__()
+        self._lock = threading.Lock()
+        self._pending = None
+        # replies still owed to commands that timed out
+        self._owed = 0
+        self._replies = queue.Queue()
+        self.events = queue.Queue()
+        self.debug = False
+        self.metrics = None
+        self.radio_cache = {}
+
+    def handle_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        if self.debug:
+            print("RECV: %s" % line)
+        if (self._pending is not None or self._owed) and not is_async_reply(line):
+            self._pending = None
+            self._replies.put(line)
+        else:
+            if self.metrics is not None:
+                self.metrics.event(line)
+            self.events.put(line)
+            self.handle_event(line)
+
+    def handle_event(self, line):
+        """Called from the reader thread for every unsolicited line"""
+
+    def command(self, cmd, timeout=None):
+        """Send cmd and return its first reply"""
+        if timeout is None:
+            timeout = command_timeout(cmd)
+        with self._lock:
+            if self.debug:
+                print("SEND: %s" % cmd)
+            if self._owed:
+                self._resync()
+            self._pending = cmd
+            start = time.time()
+            self.write_line(cmd)
+            try:
+                reply = self._replies.get(timeout=timeout)
+            except queue.Empty:
+                self._pending = None
+                self._owed += 1
+                reply = None
+            if self.metrics is not None:
+                self.metrics.command(cmd, reply, time.time() - start)
+            self._track_radio(cmd, reply)
+            if reply is None:
+                raise CommandTimeout(cmd)
+            return reply
+
+    def _resync(self):
+        """
+        Drop the late replies of commands that timed out: send 'sys get ver'
+        and discard everything up to its answer, so a late reply is never
+        taken for the answer to the next command
+        """
+        self._pending = 'sys get ver'
+        self.write_line('sys get ver')
+        deadline = time.time() + DEFAULT_TIMEOUT
+        try:
+            while True:
+                line = self._replies.get(timeout=max(0, deadline - time.time()))
+                if line.startswith(('RN2483', 'RN2903')):
+                    self._owed = 0
+                    break
+        except queue.Empty:
+            pass
+        self._pending = None
+
+    def _track_radio(self, cmd, reply):
+        if command_prefix(cmd, RADIO_RESETS):
+            self.radio_cache.clear()
+            return
+        words = cmd.split()
+        if len(words) < 3 or words[0] != 'radio' or words[2] not in RADIO_SETTINGS:
+            return
+        if words[1] == 'set':
+            if reply == 'ok' and len(words) == 4:
+                self.radio_cache[words[2]] = words[3]
+            else:
+                self.radio_cache.pop(words[2], None)
+        elif words[1] == 'get' and reply is not None and reply not in ERROR_REPLIES:
+            self.radio_cache[words[2]] = reply
+
+    def radio_set(self, key, value):
+        """
+        Send 'radio set key value' unless the radio is known to have that
+        setting already. Returns True if the command was sent.
+        """
+        value = str(value)
+        if self.radio_cache.get(key) == value:
+            return False
+        self.command_ok('radio set %s %s' % (key, value))
+        return True
+
+    def radio_get(self, key):
+        """Value of a radio setting, from the cache when it is known"""
+        value = self.radio_cache.get(key)
+        if value is None:
+            value = self.command('radio get %s' % key)
+        return value
+
+    def command_ok(self, cmd, timeout=None):
+        """Send cmd and raise CommandError unless the module answers ok"""
+        response = self.command(cmd, timeout)
+        if response != 'ok':
+            raise CommandError(cmd, response)
+        return response
+
+    def transact(self, cmd, timeout=None, second_timeout=False):
+        """
+        Send a command that has a second reply (mac tx, mac join, radio tx,
+        radio rx) and return the second reply. Raises CommandError if the
+        command is rejected before the radio operation starts.
+        """
+        self.clear_events()
+        self.command_ok(cmd, timeout)
+        return self.wait_done(cmd, second_timeout)
+
+    def wait_done(self, cmd, second_timeout=False):
+        """
+        Return the second reply of cmd, once the module accepted it. Waits
+        for the command's limit in ASYNC_TIMEOUTS unless second_timeout is
+        given.
+        """
+        if second_timeout is False:
+            second_timeout = async_timeout(cmd)
+        if self.metrics is None:
+            return self.wait_event(second_timeout, cmd)
+        start = time.time()
+        try:
+            line = self.wait_event(second_timeout, cmd)
+        except CommandTimeout:
+            self.metrics.done(cmd, None, time.time() - start)
+            raise
+        self.metrics.done(cmd, line, time.time() - start)
+        return line
+
+    def wait_event(self, timeout=None, cmd=None):
+        """Return the next unsolicited line"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            raise CommandTimeout(cmd or 'event')
+
+    def clear_events(self):
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                return
+
+
+def wait_for_module(stik, retries=3):
+    """
+    Return the version string, retrying in case the module is still booting
+    or a partial line is in its receive buffer.
+    """
+    for _ in range(retries):
+        try:
+            return stik.command('sys get ver', timeout=1)
+        except CommandTimeout:
+            time.sleep(.1)
+    raise CommandTimeout('sys get ver')
+
+
+def int_reply(value):
+    """Integer value of a get command's reply, None if it isn't one"""
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def get_int(stik, cmd):
+    """Integer value of a get command, None if the firmware doesn't support it"""
+    return int_reply(stik.command(cmd))
+
+
+def mac_airtime(sku, dr, length):
+    """Time on air of a LoRaWAN frame with a length byte PHY payload"""
+    sf, bw = DATA_RATES[sku][dr]
+    return time_on_air(sf, bw, 1, 8, 1, length)
+
+
+def max_payload(sku, dr):
+    return MAX_PAYLOAD[sku][dr]
+
+
+def radio_settings(stik):
+    """
+    The radio settings time_on_air needs, read from the module or its
+    settings cache. Raises CommandError if the radio is not in LoRa mode.
+    """
+    mod = stik.radio_get('mod')
+    if mod != 'lora':
+        raise CommandError('radio get mod', mod)
+    try:
+        return {
+            'sf': int(stik.radio_get('sf')[2:]),
+            'bw': int(stik.radio_get('bw')),
+            'cr': int(stik.radio_get('cr').split('/')[1]) - 4,
+            'prlen': int(stik.radio_get('prlen')),
+            'crc': 1 if stik.radio_get('crc') == 'on' else 0,
+        }
+    except (ValueError, IndexError):
+        raise CommandError('radio get', 'unexpected setting')
+
+
+def read_nvm(stik, address, length):
+    """Read length bytes of user NVM starting at address"""
+    data = bytearray()
+    for offset in range(length):
+        value = stik.command('sys get nvm %X' % (address + offset))
+        try:
+            data.append(int(value, 16))
+        except ValueError:
+            raise CommandError('sys get nvm %X' % (address + offset), value)
+    return bytes(data)
+
+
+def write_nvm(stik, address, data):
+    for offset, value in enumerate(bytearray(data)):
+        stik.command_ok('sys set nvm %X %02X' % (address + offset, value))
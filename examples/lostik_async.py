@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+asyncio driver for the LoStik.
+
+One event loop can drive many sticks: the serial ports are watched with
+loop.add_reader instead of a ReaderThread per port, and commands are
+awaitable. Replies are matched to commands with the same rules as
+lostik.LoStik.
+
+    async def receive(port):
+        stik = await AsyncLoStik.open(port)
+        await stik.command('mac pause')
+        async for payload in stik.radio_rx():
+            print(port, payload)
+
+    async def main(ports):
+        await asyncio.gather(*(receive(port) for port in ports))
+"""
+import argparse
+import asyncio
+import io
+import threading
+
+import serial
+
+from lostik import (BAUDRATE, CommandError, CommandTimeout, async_timeout,
+                    command_timeout, is_async_reply)
+
+
+class AsyncLoStik(object):
+
+    TERMINATOR = b'\r\n'
+    ENCODING = 'utf-8'
+
+    def __init__(self, ser, loop=None):
+        self.serial = ser
+        self.loop = loop or asyncio.get_event_loop()
+        self.debug = False
+        # a metrics.Metrics to record command latencies and replies
+        self.metrics = None
+        self._buffer = bytearray()
+        self._pending = None
+        self._lock = asyncio.Lock()
+        self._subscribers = []
+        self._fd = None
+        self._thread = None
+        self.closed = self.loop.create_future()
+
+    @classmethod
+    async def open(cls, port, baudrate=BAUDRATE):
+        stik = cls(serial.serial_for_url(port, baudrate=baudrate, timeout=0))
+        stik.start()
+        return stik
+
+    def start(self):
+        """Start watching the serial port"""
+        try:
+            self._fd = self.serial.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # not a file descriptor (e.g. an emulated port), read from a thread
+            self.serial.timeout = .1
+            self._thread = threading.Thread(target=self._read_thread, name='lostik-rx')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self.loop.add_reader(self._fd, self._read_ready)
+
+    def close(self):
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            self._fd = None
+        self.serial.close()
+        if self._thread is not None:
+            self._thread.join()
+        self._connection_lost(None)
+
+    def _read_ready(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except serial.SerialException as e:
+            self.loop.remove_reader(self._fd)
+            self._fd = None
+            self._connection_lost(e)
+            return
+        if data:
+            self.data_received(data)
+
+    def _read_thread(self):
+        while self.serial.is_open:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except serial.SerialException as e:
+                self.loop.call_soon_threadsafe(self._connection_lost, e)
+                return
+            if data:
+                self.loop.call_soon_threadsafe(self.data_received, data)
+
+    def _connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        if self._pending is not None and not self._pending.done():
+            self._pending.set_exception(exc or serial.SerialException('port closed'))
+
+    # - - - protocol - - -
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        while self.TERMINATOR in self._buffer:
+            packet, self._buffer = self._buffer.split(self.TERMINATOR, 1)
+            self.handle_line(packet.decode(self.ENCODING, 'replace').strip())
+
+    def handle_line(self, line):
+        if not line:
+            return
+        if self.debug:
+            print("RECV: %s" % line)
+        if self._pending is not None and not self._pending.done() and not is_async_reply(line):
+            self._pending.set_result(line)
+            return
+        if self.metrics is not None:
+            self.metrics.event(line)
+        for queue in self._subscribers:
+            queue.put_nowait(line)
+        self.handle_event(line)
+
+    def handle_event(self, line):
+        """Called for every unsolicited line"""
+
+    def subscribe(self):
+        """Return a queue that receives every unsolicited line from now on"""
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.remove(queue)
+
+    async def events(self):
+        """Iterate over unsolicited lines"""
+        queue = self.subscribe()
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(queue)
+
+    # - - - commands - - -
+
+    async def command(self, cmd, timeout=None):
+        """Send cmd and return its first reply"""
+        if timeout is None:
+            timeout = command_timeout(cmd)
+        async with self._lock:
+            if self.debug:
+                print("SEND: %s" % cmd)
+            self._pending = self.loop.create_future()
+            start = self.loop.time()
+            self.serial.write(cmd.encode(self.ENCODING) + self.TERMINATOR)
+            reply = None
+            try:
+                reply = await asyncio.wait_for(self._pending, timeout)
+                return reply
+            except asyncio.TimeoutError:
+                raise CommandTimeout(cmd)
+            finally:
+                self._pending = None
+                if self.metrics is not None:
+                    self.metrics.command(cmd, reply, self.loop.time() - start)
+
+    async def command_ok(self, cmd, timeout=None):
+        response = await self.command(cmd, timeout)
+        if response != 'ok':
+            raise CommandError(cmd, response)
+        return response
+
+    async def transact(self, cmd, timeout=None, second_timeout=False):
+        """Send a command that has a second reply and return the second reply"""
+        queue = self.subscribe()
+        try:
+            await self.command_ok(cmd, timeout)
+            if second_timeout is False:
+                second_timeout = async_timeout(cmd)
+            start = self.loop.time()
+            line = None
+            try:
+                line = await asyncio.wait_for(queue.get(), second_timeout)
+                return line
+            except asyncio.TimeoutError:
+                raise CommandTimeout(cmd)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.done(cmd, line, self.loop.time() - start)
+        finally:
+            self.unsubscribe(queue)
+
+    async def join(self, mode='otaa'):
+        """Join the network, returns 'accepted' or 'denied'"""
+        return await self.transact('mac join %s' % mode)
+
+    async def mac_tx(self, port, data, confirmed=False):
+        return await self.transact('mac tx %s %d %s' % ('cnf' if confirmed else 'uncnf', port, data))
+
+    async def radio_tx(self, data):
+        return await self.transact('radio tx %s' % data)
+
+    async def radio_rx(self, symbols=0):
+        """Keep the receiver armed and yield the hex payload of every frame"""
+        while True:
+            line = await self.transact('radio rx %d' % symbols)
+            if line.startswith('radio_rx'):
+                yield line.split()[1]
+
+    async def mac_rx(self):
+        """Yield (port, hex payload) of every downlink"""
+        async for line in self.events():
+            if line.startswith('mac_rx'):
+                fields = line.split()
+                yield int(fields[1]), fields[2] if len(fields) > 2 else ''
+
+
+async def receive(port):
+    stik = await AsyncLoStik.open(port)
+    print("%s: %s" % (port, await stik.command('sys get ver')))
+    await stik.command('mac pause')
+    await stik.command_ok('radio set pwr 10')
+    async for payload in stik.radio_rx():
+        print("%s: %s" % (port, payload))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receive on several LoStiks from one event loop')
+    parser.add_argument('ports', nargs='+', help="Serial ports of the LoStiks")
+    args = parser.parse_args()
+
+    async def receive_all():
+        await asyncio.gather(*(receive(port) for port in args.ports))
+
+    try:
+        asyncio.run(receive_all())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Command latency and outcome metrics for LoStik drivers.
+
+Give a LoStik (or AsyncLoStik) a Metrics instance and every command is
+recorded: how long the first reply took, how long the second reply of
+mac join / mac tx / radio tx / radio rx took, and which replies came back.
+The numbers are served in the Prometheus text format on localhost and can be
+dumped to a JSON file periodically.
+
+    metrics = Metrics()
+    stik.metrics = metrics
+    MetricsServer(metrics, 9105).start()
+    JsonDump(metrics, 'metrics.json', 60).start()
+
+    curl http://127.0.0.1:9105/metrics
+
+Scripts using lostik.py take --metrics-port and --metrics-json through
+add_arguments()/from_args().
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lostik import ASYNC_REPLIES, ASYNC_TIMEOUTS, ERROR_REPLIES, command_prefix
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+PREFIX = 'lostik'
+
+
+def command_verb(cmd):
+    """Group commands by what they do: 'mac tx', 'radio get', 'sys reset', ..."""
+    prefix = command_prefix(cmd, ASYNC_TIMEOUTS)
+    if prefix:
+        return prefix
+    return ' '.join(cmd.split()[:2])
+
+
+def reply_type(reply):
+    """Label for a reply, values of get commands are all 'value'"""
+    if reply is None:
+        return 'timeout'
+    word = reply.split(' ', 1)[0]
+    if word == 'ok' or word in ERROR_REPLIES or word in ASYNC_REPLIES:
+        return word
+    return 'value'
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+    """Thread safe counters and latency histograms keyed by command verb"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (verb, phase) -> Histogram, phase is 'reply' or 'done'
+        self.latency = {}
+        # (verb, reply type) -> count
+        self.replies = {}
+        # unsolicited lines by reply type
+        self.events = {}
+        self.started = time.time()
+
+    def command(self, cmd, reply, seconds):
+        """First reply of cmd arrived (reply None: timed out) after seconds"""
+        self._record(command_verb(cmd), 'reply', reply, seconds)
+
+    def done(self, cmd, reply, seconds):
+        """Second reply of cmd arrived seconds after the first one"""
+        self._record(command_verb(cmd), 'done', reply, seconds)
+
+    def event(self, line):
+        with self._lock:
+            kind = reply_type(line)
+            self.events[kind] = self.events.get(kind, 0) + 1
+
+    def _record(self, verb, phase, reply, seconds):
+        with self._lock:
+            histogram = self.latency.get((verb, phase))
+            if histogram is None:
+                histogram = self.latency[(verb, phase)] = Histogram()
+            histogram.observe(seconds)
+            key = (verb, reply_type(reply))
+            self.replies[key] = self.replies.get(key, 0) + 1
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines.append('# HELP %s_command_seconds Time from sending a command to its reply '
+                         '(phase reply) and from then to its second reply (phase done)' % PREFIX)
+            lines.append('# TYPE %s_command_seconds histogram' % PREFIX)
+            for (verb, phase), histogram in sorted(self.latency.items()):
+                labels = 'verb="%s",phase="%s"' % (verb, phase)
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_command_seconds_bucket{%s,le="%s"} %d' % (
+                        PREFIX, labels, '+Inf' if bound == float('inf') else repr(float(bound)), count))
+                lines.append('%s_command_seconds_sum{%s} %r' % (PREFIX, labels, histogram.sum))
+                lines.append('%s_command_seconds_count{%s} %d' % (PREFIX, labels, histogram.count))
+            lines.append('# HELP %s_replies_total Replies by command verb and reply type' % PREFIX)
+            lines.append('# TYPE %s_replies_total counter' % PREFIX)
+            for (verb, reply), count in sorted(self.replies.items()):
+                lines.append('%s_replies_total{verb="%s",reply="%s"} %d' % (PREFIX, verb, reply, count))
+            lines.append('# HELP %s_events_total Unsolicited lines from the module' % PREFIX)
+            lines.append('# TYPE %s_events_total counter' % PREFIX)
+            for kind, count in sorted(self.events.items()):
+                lines.append('%s_events_total{type="%s"} %d' % (PREFIX, kind, count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Metrics as a JSON serializable dict"""
+        with self._lock:
+            return {
+                'started': self.started,
+                'timestamp': time.time(),
+                'latency': dict(
+                    ('%s/%s' % key, {
+                        'count': histogram.count,
+                        'sum': histogram.sum,
+                        'buckets': dict(
+                            ('+Inf' if bound == float('inf') else str(bound), count)
+                            for bound, count in histogram.cumulative()),
+                    }) for key, histogram in sorted(self.latency.items())),
+                'replies': dict(('%s/%s' % key, count) for key, count in sorted(self.replies.items())),
+                'events': dict(self.events),
+            }
+
+
+class MetricsServer(object):
+    """Serve /metrics in the Prometheus text format from a daemon thread"""
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-http')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JsonDump(object):
+    """Write Metrics.snapshot() to path every interval seconds"""
+
+    def __init__(self, metrics, path, interval=60.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-json')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        self.dump()
+
+    def dump(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-port', help="Serve Prometheus metrics on this localhost port", type=int)
+    parser.add_argument('--metrics-json', help="Dump metrics to this JSON file")
+    parser.add_argument('--metrics-interval', help="Seconds between JSON dumps", type=float, default=60)
+
+
+def from_args(args):
+    """Metrics with the exporters asked for on the command line, None if none"""
+    if args.metrics_port is None and not args.metrics_json:
+        return None
+    metrics = Metrics()
+    if args.metrics_port is not None:
+        MetricsServer(metrics, args.metrics_port).start()
+    if args.metrics_json:
+        # write the final numbers however the script exits
+        atexit.register(JsonDump(metrics, args.metrics_json, args.metrics_interval).start().stop)
+    return metrics
@@ -11,6 +11,7 @@ import codecs
 import os
 import sys
 import threading
+import time
 
 import serial
 from serial.tools.list_ports import comports
@@ -20,6 +21,11 @@ from serial.tools import hexlify_codec
 
 codecs.register(lambda c: hexlify_codec.getregentry() if c == 'hexlify' else None)
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     raw_input
 except NameError:
@@ -176,6 +182,12 @@ else:
 
 class Transform(object):
     """do-nothing: forward all data unchanged"""
+
+    # transformations whose rx works character by character implement
+    # rx_char(ordinal) -> text, which lets Miniterm fuse them into one
+    # str.translate table
+    rx_char = None
+
     def rx(self, text):
         """text received from serial port"""
         return text
@@ -202,6 +214,9 @@ class CR(Transform):
     def rx(self, text):
         return text.replace('\r', '\n')
 
+    def rx_char(self, ordinal):
+        return '\n' if ordinal == 0x0D else unichr(ordinal)
+
     def tx(self, text):
         return text.replace('\n', '\r')
 
@@ -223,6 +238,9 @@ class NoTerminal(Transform):
     def rx(self, text):
         return text.translate(self.REPLACEMENT_MAP)
 
+    def rx_char(self, ordinal):
+        return unichr(self.REPLACEMENT_MAP.get(ordinal, ordinal))
+
     echo = rx
 
 
@@ -241,17 +259,20 @@ class NoControls(NoTerminal):
 class Printable(Transform):
     """Show decimal code for all non-ASCII characters and replace most control codes"""
 
+    def __init__(self):
+        self.table = TranslationTable([self])
+
     def rx(self, text):
-        r = []
-        for c in text:
-            if ' ' <= c < '\x7f' or c in '\r\n\b\t':
-                r.append(c)
-            elif c < ' ':
-                r.append(unichr(0x2400 + ord(c)))
-            else:
-                r.extend(unichr(0x2080 + ord(d) - 48) for d in '{:d}'.format(ord(c)))
-                r.append(' ')
-        return ''.join(r)
+        return text.translate(self.table)
+
+    def rx_char(self, ordinal):
+        c = unichr(ordinal)
+        if ' ' <= c < '\x7f' or c in '\r\n\b\t':
+            return c
+        elif c < ' ':
+            return unichr(0x2400 + ordinal)
+        else:
+            return ''.join(unichr(0x2080 + ord(d) - 48) for d in '{:d}'.format(ordinal)) + ' '
 
     echo = rx
 
@@ -285,6 +306,47 @@ class DebugIO(Transform):
         return text
 
 
+class TranslationTable(dict):
+    """\
+    str.translate table for a sequence of per-character transformations.
+    Entries are computed the first time a character is seen, so the table
+    also covers characters outside the ones precomputed here.
+    """
+
+    def __init__(self, transformations):
+        super(TranslationTable, self).__init__()
+        self.transformations = transformations
+        for ordinal in range(256):
+            self[ordinal] = self.__missing__(ordinal)
+
+    def __missing__(self, ordinal):
+        text = unichr(ordinal)
+        for transformation in self.transformations:
+            text = ''.join(transformation.rx_char(ord(c)) for c in text)
+        self[ordinal] = text
+        return text
+
+
+def rx_pipeline(transformations):
+    """\
+    Compile rx transformations (in the order they are applied) into a list
+    of functions. Runs of per-character transformations become a single
+    str.translate call and do-nothing transformations are dropped.
+    """
+    pipeline = []
+    run = []
+    for transformation in transformations + [None]:
+        if transformation is not None and transformation.rx_char is not None:
+            run.append(transformation)
+            continue
+        if run:
+            pipeline.append(lambda text, table=TranslationTable(run): text.translate(table))
+            run = []
+        if transformation is not None and type(transformation).rx is not Transform.rx:
+            pipeline.append(transformation.rx)
+    return pipeline
+
+
 # other ideas:
 # - add date/time for each newline
 # - insert newline after: a) timeout b) packet end character
@@ -306,15 +368,111 @@ TRANSFORMATIONS = {
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class SessionLog(object):
+    """\
+    Log of the bytes sent and received, one timestamped line per chunk:
+
+        1546300800.123456 RX radio_rx  48656C6C6F\\r\\n
+
+    Chunks are handed to a writer thread through a bounded queue, so a slow
+    disk never blocks the serial reader. If the queue is full the chunk is
+    left out of the log (serial data is unaffected) and the number of
+    dropped bytes is logged once there is room again. The file is flushed
+    when the queue runs empty, and at least every flush_interval seconds or
+    flush_bytes bytes under sustained traffic. It is rotated like
+    logging.handlers.RotatingFileHandler: when it grows past max_bytes it is
+    renamed to path.1 (path.1 to path.2 and so on, keeping backups).
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5, queue_size=10000,
+                 flush_interval=1.0, flush_bytes=64 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = open(path, 'ab')
+        self._thread = threading.Thread(target=self._write, name='log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def rx(self, data):
+        self._put(b'RX', data)
+
+    def tx(self, data):
+        self._put(b'TX', data)
+
+    def _put(self, direction, data):
+        try:
+            self._queue.put_nowait((time.time(), direction, data))
+        except queue.Full:
+            self.dropped += len(data)
+
+    def _write(self):
+        dropped = 0
+        flushed_at = time.time()
+        flushed_bytes = self._file.tell()
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if self.dropped != dropped:
+                self._file.write('{:.6f} -- {} bytes not logged\n'.format(
+                    record[0], self.dropped - dropped).encode('ascii'))
+                dropped = self.dropped
+            timestamp, direction, data = record
+            self._file.write('{:.6f} '.format(timestamp).encode('ascii') + direction +
+                             b' ' + codecs.escape_encode(data)[0] + b'\n')
+            size = self._file.tell()
+            if self.max_bytes and size >= self.max_bytes:
+                self._rotate()
+                flushed_at = time.time()
+                flushed_bytes = 0
+            elif (self._queue.empty() or size - flushed_bytes >= self.flush_bytes or
+                    time.time() - flushed_at >= self.flush_interval):
+                self._file.flush()
+                flushed_at = time.time()
+                flushed_bytes = size
+        self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        if self.backups:
+            for n in range(self.backups - 1, 0, -1):
+                source = '{}.{}'.format(self.path, n)
+                if os.path.exists(source):
+                    self._replace(source, '{}.{}'.format(self.path, n + 1))
+            self._replace(self.path, self.path + '.1')
+        self._file = open(self.path, 'wb')
+
+    @staticmethod
+    def _replace(source, destination):
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+    def close(self):
+        """Write out what is queued and close the file"""
+        self._queue.put(None)
+        self._thread.join()
+
+
 def ask_for_port():
     """\
     Show a list of ports and ask the user for a choice. To make selection
     easier on systems with long device names, also allow the input of an
-    index.
+    index. LoStiks known from discovery.py's cache are shown with their SKU
+    and hweui.
     """
+    from discovery import DeviceCache
+    known = DeviceCache().connected()
     sys.stderr.write('\n--- Available ports:\n')
     ports = []
     for n, (port, desc, hwid) in enumerate(sorted(comports()), 1):
+        if port in known:
+            desc = '{} [{} {}]'.format(desc, known[port]['sku'], known[port]['hweui'])
         sys.stderr.write('--- {:2}: {:20} {}\n'.format(n, port, desc))
         ports.append(port)
     while True:
@@ -337,8 +495,10 @@ class Miniterm(object):
     Handle special keys from the console to show menu etc.
     """
 
-    def __init__(self, serial_instance, echo=False, eol='crlf', filters=()):
-        self.console = Console()
+    def __init__(self, serial_instance, echo=False, eol='crlf', filters=(), log=None, headless=False):
+        # headless: no console at all, only log the session
+        self.console = None if headless else Console()
+        self.log = log
         self.serial = serial_instance
         self.echo = echo
         self.raw = False
@@ -374,6 +534,9 @@ class Miniterm(object):
         """start worker threads"""
         self.alive = True
         self._start_reader()
+        if self.console is None:
+            self.transmitter_thread = None
+            return
         # enter console->serial loop
         self.transmitter_thread = threading.Thread(target=self.writer, name='tx')
         self.transmitter_thread.daemon = True
@@ -386,7 +549,11 @@ class Miniterm(object):
 
     def join(self, transmit_only=False):
         """wait for worker threads to terminate"""
-        self.transmitter_thread.join()
+        if self.transmitter_thread is not None:
+            self.transmitter_thread.join()
+        elif transmit_only:
+            # headless, runs until the port fails or the user interrupts
+            self.receiver_thread.join()
         if not transmit_only:
             if hasattr(self.serial, 'cancel_read'):
                 self.serial.cancel_read()
@@ -394,6 +561,8 @@ class Miniterm(object):
 
     def close(self):
         self.serial.close()
+        if self.log is not None:
+            self.log.close()
 
     def update_transformations(self):
         """take list of transformation classes and instantiate them for rx and tx"""
@@ -401,6 +570,7 @@ class Miniterm(object):
                                                              for f in self.filters]
         self.tx_transformations = [t() for t in transformations]
         self.rx_transformations = list(reversed(self.tx_transformations))
+        self.rx_pipeline = rx_pipeline(self.rx_transformations)
 
     def set_rx_encoding(self, encoding, errors='replace'):
         """set encoding for received data"""
@@ -444,16 +614,21 @@ class Miniterm(object):
                 # read all that is there or wait for one byte
                 data = self.serial.read(self.serial.in_waiting or 1)
                 if data:
-                    if self.raw:
+                    if self.log is not None:
+                        self.log.rx(data)
+                    if self.console is None:
+                        pass
+                    elif self.raw:
                         self.console.write_bytes(data)
                     else:
                         text = self.rx_decoder.decode(data)
-                        for transformation in self.rx_transformations:
-                            text = transformation.rx(text)
+                        for rx in self.rx_pipeline:
+                            text = rx(text)
                         self.console.write(text)
         except serial.SerialException:
             self.alive = False
-            self.console.cancel()
+            if self.console is not None:
+                self.console.cancel()
             raise       # XXX handle instead of re-raise?
 
     def writer(self):
@@ -484,7 +659,10 @@ class Miniterm(object):
                     text = c
                     for transformation in self.tx_transformations:
                         text = transformation.tx(text)
-                    self.serial.write(self.tx_encoder.encode(text))
+                    data = self.tx_encoder.encode(text)
+                    self.serial.write(data)
+                    if self.log is not None:
+                        self.log.tx(data)
                     if self.echo:
                         echo_text = c
                         for transformation in self.tx_transformations:
@@ -712,7 +890,7 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
     parser.add_argument(
         "port",
         nargs='?',
-        help="serial port name ('-' to show port list)",
+        help="serial port name ('-' to show port list), LoStik hweui or 'auto'",
         default=default_port)
 
     parser.add_argument(
@@ -796,6 +974,43 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
         help="Do no apply any encodings/transformations",
         default=False)
 
+    group.add_argument(
+        "--script",
+        metavar="FILE",
+        help="send the RN2xx3 commands in FILE ('-' for stdin) one after another and exit")
+
+    group = parser.add_argument_group("session log")
+
+    group.add_argument(
+        "--log",
+        metavar="FILE",
+        help="append timestamped rx/tx data to FILE")
+
+    group.add_argument(
+        "--log-max-bytes",
+        type=int,
+        metavar="NUM",
+        help="rotate the log when it grows past NUM bytes, 0 to never rotate, default: %(default)s",
+        default=10 * 1024 * 1024)
+
+    group.add_argument(
+        "--log-backups",
+        type=int,
+        metavar="NUM",
+        help="number of rotated logs to keep, default: %(default)s",
+        default=5)
+
+    group.add_argument(
+        "--headless",
+        action="store_true",
+        help="no console, only log the session (requires --log)",
+        default=False)
+
+    group.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record all serial traffic to the binary trace FILE (see wiretrace.py)")
+
     group = parser.add_argument_group("hotkeys")
 
     group.add_argument(
@@ -831,6 +1046,9 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
     if args.menu_char == args.exit_char:
         parser.error('--exit-char can not be the same as --menu-char')
 
+    if args.headless and not args.log:
+        parser.error('--headless needs --log')
+
     if args.filter:
         if 'help' in args.filter:
             sys.stderr.write('Available filters:\n')
@@ -843,6 +1061,8 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
     else:
         filters = ['default']
 
+    from discovery import resolve
+
     while True:
         # no port given on command line -> ask user now
         if args.port is None or args.port == '-':
@@ -855,6 +1075,7 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
                 if not args.port:
                     parser.error('port is not given')
         try:
+            args.port = resolve(args.port)
             serial_instance = serial.serial_for_url(
                 args.port,
                 args.baudrate,
@@ -888,11 +1109,33 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
         else:
             break
 
+    if args.trace:
+        from wiretrace import TraceWriter, TracingSerial
+        serial_instance = TracingSerial(serial_instance, TraceWriter(args.trace))
+
+    log = None
+    if args.log:
+        log = SessionLog(args.log, args.log_max_bytes, args.log_backups)
+
+    if args.script:
+        try:
+            if args.script == '-':
+                ok = run_script(serial_instance, sys.stdin, args.quiet, log)
+            else:
+                with open(args.script) as script:
+                    ok = run_script(serial_instance, script, args.quiet, log)
+        finally:
+            if log is not None:
+                log.close()
+        sys.exit(0 if ok else 1)
+
     miniterm = Miniterm(
         serial_instance,
         echo=args.echo,
         eol=args.eol.lower(),
-        filters=filters)
+        filters=filters,
+        log=log,
+        headless=args.headless)
     miniterm.exit_character = unichr(args.exit_char)
     miniterm.menu_character = unichr(args.menu_char)
     miniterm.raw = args.raw
@@ -902,22 +1145,77 @@ def main(default_port=None, default_baudrate=9600, default_rts=None, default_dtr
     if not args.quiet:
         sys.stderr.write('--- Miniterm on {p.name}  {p.baudrate},{p.bytesize},{p.parity},{p.stopbits} ---\n'.format(
             p=miniterm.serial))
-        sys.stderr.write('--- Quit: {} | Menu: {} | Help: {} followed by {} ---\n'.format(
-            key_description(miniterm.exit_character),
-            key_description(miniterm.menu_character),
-            key_description(miniterm.menu_character),
-            key_description('\x08')))
+        if args.headless:
+            sys.stderr.write('--- Logging to {} | Quit: Ctrl+C ---\n'.format(args.log))
+        else:
+            sys.stderr.write('--- Quit: {} | Menu: {} | Help: {} followed by {} ---\n'.format(
+                key_description(miniterm.exit_character),
+                key_description(miniterm.menu_character),
+                key_description(miniterm.menu_character),
+                key_description('\x08')))
 
     miniterm.start()
     try:
         miniterm.join(True)
     except KeyboardInterrupt:
-        pass
+        miniterm.stop()
     if not args.quiet:
         sys.stderr.write("\n--- exit ---\n")
     miniterm.join()
     miniterm.close()
 
+
+def run_script(serial_instance, script, quiet=False, log=None, rx_timeout=60):
+    """\
+    Send the RN2xx3 commands in script (one per line, # for comments) one
+    at a time, each as soon as the previous one is answered. Commands with
+    a second reply (mac join, mac tx, radio tx/rx) wait for it as well, a
+    radio rx for at most rx_timeout seconds as it may never end otherwise.
+    Stops at the first error reply or timeout. Returns True if every
+    command succeeded. Traffic is recorded in log, a SessionLog, if given.
+    """
+    from serial.threaded import ReaderThread
+    from lostik import LoStik, CommandError, ERROR_REPLIES, async_timeout, has_second_reply
+
+    class ScriptStik(LoStik):
+        def data_received(self, data):
+            if log is not None:
+                log.rx(data)
+            super(ScriptStik, self).data_received(data)
+
+        def write_line(self, text):
+            data = text.encode(self.ENCODING, self.UNICODE_HANDLING) + self.TERMINATOR
+            if log is not None:
+                log.tx(data)
+            self.transport.write(data)
+
+    with ReaderThread(serial_instance, ScriptStik) as stik:
+        latencies = []
+        for line in script:
+            cmd = line.strip()
+            if not cmd or cmd.startswith('#'):
+                continue
+            start = time.time()
+            try:
+                if has_second_reply(cmd):
+                    timeout = async_timeout(cmd)
+                    reply = stik.transact(cmd, second_timeout=rx_timeout if timeout is None else timeout)
+                else:
+                    reply = stik.command(cmd)
+            except CommandError as e:
+                reply = e.response
+            latencies.append(time.time() - start)
+            sys.stdout.write('{} -> {} ({:.1f} ms)\n'.format(cmd, reply, latencies[-1] * 1000))
+            if reply is None or reply in ERROR_REPLIES:
+                sys.stderr.write('--- stopped at {!r}: {}\n'.format(cmd, reply or 'timeout'))
+                return False
+        if latencies and not quiet:
+            sys.stderr.write('--- {} commands in {:.2f} s, mean {:.1f} ms, max {:.1f} ms\n'.format(
+                len(latencies), sum(latencies), sum(latencies) / len(latencies) * 1000,
+                max(latencies) * 1000))
+    return True
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 if __name__ == '__main__':
     main()
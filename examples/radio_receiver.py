@@ -1,49 +1,161 @@
 #!/usr/bin/env python3
 import time
 import sys
-import serial
+import queue
+import threading
 import argparse 
 
-from serial.threaded import LineReader, ReaderThread
+from serial.threaded import ReaderThread
+
+from lostik import LoStik, CommandError, DEFAULT_TIMEOUT, get_int, rx_symbols
+from capture import CaptureWriter
+from scan import Scanner, load_plan
+import metrics
+import wiretrace
 
 parser = argparse.ArgumentParser(description='LoRa Radio mode receiver.')
 parser.add_argument('port', help="Serial port descriptor")
+parser.add_argument('--capture', '-c', help="Append received frames to this capture file")
+parser.add_argument('--scan', help="Hop across the channels of this configure.py config file, e.g. ttn-us.conf")
+parser.add_argument('--dwell', help="Shortest time in seconds to listen on a channel while scanning",
+                    type=float, default=1)
+parser.add_argument('--sweep', help="Seconds per pass over all channels, default twice the shortest",
+                    type=float)
+metrics.add_arguments(parser)
+wiretrace.add_arguments(parser)
 args = parser.parse_args()
 
-class PrintLines(LineReader):
+class PrintLines(LoStik):
 
     def connection_made(self, transport):
+        super(PrintLines, self).connection_made(transport)
         print("connection made")
-        self.transport = transport
+        self.frames = queue.Queue()
+        self.capture = None
+
+    def setup(self):
         self.send_cmd('sys get ver')
         self.send_cmd('mac pause')
         self.send_cmd('radio set pwr 10')
-        self.send_cmd('radio rx 0')
-        self.send_cmd("sys set pindig GPIO10 0")
+        self.led(0)
+        self.freq = get_int(self, 'radio get freq')
+        self.sf = int(self.send_cmd('radio get sf')[2:])
+        self.bw = get_int(self, 'radio get bw')
 
-    def handle_line(self, data):
-        if data == "ok" or data == 'busy':
+    def receive(self):
+        """
+        Re-arm the receiver as soon as a frame or radio_err arrives. Frames
+        are handed to the print_frames worker so printing and the LED never
+        keep the radio deaf.
+        """
+        try:
+            data = self.transact('radio rx 0')
+        except CommandError as e:
+            print(e)
+            time.sleep(.1)
             return
-        if data == "radio_err":
-            self.send_cmd('radio rx 0')
-            return
-        
-        self.send_cmd("sys set pindig GPIO10 1", delay=0)
-        print(data)
-        time.sleep(.1)
-        self.send_cmd("sys set pindig GPIO10 0", delay=1)
-        self.send_cmd('radio rx 0')
+        if data.startswith("radio_rx"):
+            received = time.time()
+            if self.capture:
+                # only valid until the next frame, so read before re-arming
+                self.frames.put((received, self.freq, self.bw, data, get_int(self, 'radio get rssi'),
+                                 get_int(self, 'radio get snr')))
+            else:
+                self.frames.put((received, self.freq, self.bw, data, None, None))
+
+    def scan(self, scanner):
+        """
+        One sweep over the channel plan: listen on each channel for its
+        dwell time in 'radio rx' windows, re-armed after every frame.
+        """
+        for channel in scanner.channels:
+            self.radio_set('freq', channel.freq)
+            self.radio_set('bw', channel.bw)
+            self.freq = channel.freq
+            self.bw = channel.bw
+            dwell = scanner.dwell(channel)
+            start = time.monotonic()
+            frames = 0
+            rssi = []
+            while True:
+                remaining = dwell - (time.monotonic() - start)
+                if remaining <= 2 ** self.sf / (channel.bw * 1000.0):
+                    break
+                try:
+                    data = self.transact('radio rx %d' % rx_symbols(self.sf, channel.bw, remaining),
+                                         second_timeout=remaining + DEFAULT_TIMEOUT)
+                except CommandError as e:
+                    print(e)
+                    time.sleep(.1)
+                    continue
+                if data.startswith("radio_rx"):
+                    frames += 1
+                    frame_rssi = get_int(self, 'radio get rssi')
+                    if frame_rssi is not None:
+                        rssi.append(frame_rssi)
+                    self.frames.put((time.time(), channel.freq, channel.bw, data, frame_rssi,
+                                     get_int(self, 'radio get snr')))
+            scanner.record(channel, time.monotonic() - start, frames, rssi)
+
+    def led(self, on):
+        """Switch the blue LED"""
+        self.send_cmd("sys set pindig GPIO10 %d" % on)
+
+    def print_frames(self):
+        """Worker printing and capturing frames and blinking the blue LED"""
+        while True:
+            frame = self.frames.get()
+            self.led(1)
+            self.output(frame)
+            # write anything that arrived meanwhile under the same blink
+            while not self.frames.empty():
+                self.output(self.frames.get())
+            if self.capture:
+                self.capture.flush()
+            time.sleep(.1)
+            self.led(0)
+
+    def output(self, frame):
+        received, freq, bw, data, rssi, snr = frame
+        if args.scan:
+            print("%d %s" % (freq, data))
+        else:
+            print(data)
+        if self.capture:
+            payload = bytes.fromhex(data.split()[1]) if len(data.split()) > 1 else b''
+            self.capture.write(received, freq, self.sf, bw, rssi, snr, payload)
 
     def connection_lost(self, exc):
         if exc:
             print(exc)
         print("port closed")
 
-    def send_cmd(self, cmd, delay=.5):
-        self.transport.write(('%s\r\n' % cmd).encode('UTF-8'))
-        time.sleep(delay)
+    def send_cmd(self, cmd):
+        return self.command(cmd)
 
-ser = serial.Serial(args.port, baudrate=57600)
+ser = wiretrace.open_port(args, args.port)
 with ReaderThread(ser, PrintLines) as protocol:
-    while(1):
-        pass
\ No newline at end of file
+    protocol.metrics = metrics.from_args(args)
+    protocol.setup()
+    if args.capture:
+        protocol.capture = CaptureWriter(args.capture)
+    worker = threading.Thread(target=protocol.print_frames, name='print_frames')
+    worker.daemon = True
+    worker.start()
+    try:
+        if args.scan:
+            scanner = Scanner(load_plan(args.scan), args.dwell, args.sweep)
+            try:
+                while True:
+                    protocol.scan(scanner)
+                    print("Sweep %d: %d frames so far, on %d channels" % (
+                        scanner.sweeps, sum(c.frames for c in scanner.channels),
+                        sum(1 for c in scanner.channels if c.frames)))
+            except KeyboardInterrupt:
+                print("\n".join(scanner.heatmap()))
+        else:
+            while True:
+                protocol.receive()
+    finally:
+        if protocol.capture:
+            protocol.capture.close()
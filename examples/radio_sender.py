@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
 import time
 import sys
-import serial
 import argparse 
 
-from serial.threaded import LineReader, ReaderThread
+from serial.threaded import ReaderThread
+
+from lostik import LoStik, CommandError, radio_settings, time_on_air
+import metrics
+import wiretrace
+
+# radio_receiver.py and capture_stats.py expect (unix time, frame count)
+PAYLOAD_SIZE = 8
 
 parser = argparse.ArgumentParser(description='LoRa Radio mode sender.')
 parser.add_argument('port', help="Serial port descriptor")
+parser.add_argument('--burst', '-b', help="Send the next frame as soon as the last one is out",
+                    action='store_true')
+parser.add_argument('--interval', '-i', help="Seconds between frames", type=float, default=10)
+parser.add_argument('--count', '-n', help="Stop after this many frames", type=int)
+parser.add_argument('--report', help="Seconds between burst statistics", type=float, default=10)
+metrics.add_arguments(parser)
+wiretrace.add_arguments(parser)
 args = parser.parse_args()
 
-class PrintLines(LineReader):
+class PrintLines(LoStik):
 
     def connection_made(self, transport):
+        super(PrintLines, self).connection_made(transport)
         print("connection made")
-        self.transport = transport
+        self.frame_count = 0
+
+    def setup(self):
         self.send_cmd("sys set pindig GPIO11 0")
         self.send_cmd('sys get ver')
         self.send_cmd('radio get mod')
@@ -23,11 +39,11 @@ class PrintLines(LineReader):
         self.send_cmd('mac pause')
         self.send_cmd('radio set pwr 10')
         self.send_cmd("sys set pindig GPIO11 0")
-        self.frame_count = 0
+        self.airtime = time_on_air(length=PAYLOAD_SIZE, **radio_settings(self))
+        print("Time on air: %.1f ms, at most %.2f packets/s" % (
+            self.airtime * 1000, 1 / self.airtime))
 
-    def handle_line(self, data):
-        if data == "ok":
-            return
+    def handle_event(self, data):
         print("RECV: %s" % data)
 
     def connection_lost(self, exc):
@@ -37,20 +53,66 @@ class PrintLines(LineReader):
 
     def tx(self):
         self.send_cmd("sys set pindig GPIO11 1")
-        txmsg = 'radio tx %x%x' % (int(time.time()), self.frame_count)
-        self.send_cmd(txmsg)
-        time.sleep(.3)
+        txmsg = 'radio tx %08x%08x' % (int(time.time()), self.frame_count)
+        print("SEND: %s" % txmsg)
+        try:
+            self.transact(txmsg)
+        except CommandError as e:
+            print("RECV: %s" % e.response)
         self.send_cmd("sys set pindig GPIO11 0")
         self.frame_count = self.frame_count + 1
 
-    def send_cmd(self, cmd, delay=.5):
+    def burst(self, count=None, report=10):
+        """
+        Transmit back to back, starting each frame as soon as radio_tx_ok
+        for the previous one arrives, and compare the achieved rate with the
+        time on air limit.
+        """
+        self.send_cmd("sys set pindig GPIO11 1")
+        start = last_report = time.time()
+        sent = failed = 0
+        try:
+            while count is None or sent + failed < count:
+                try:
+                    reply = self.transact('radio tx %08x%08x' % (int(time.time()), self.frame_count))
+                except CommandError as e:
+                    reply = e.response
+                if reply == 'radio_tx_ok':
+                    sent += 1
+                else:
+                    failed += 1
+                self.frame_count = self.frame_count + 1
+                now = time.time()
+                if now - last_report >= report:
+                    self.report(sent, failed, now - start)
+                    last_report = now
+        finally:
+            self.report(sent, failed, time.time() - start)
+            self.send_cmd("sys set pindig GPIO11 0")
+
+    def report(self, sent, failed, elapsed):
+        rate = sent / elapsed if elapsed else 0
+        print("Sent %d (%d failed) in %.1f s: %.2f packets/s of %.2f theoretical (%.0f%% airtime)" % (
+            sent, failed, elapsed, rate, 1 / self.airtime, 100 * rate * self.airtime))
+
+    def send_cmd(self, cmd):
         print("SEND: %s" % cmd)
-        self.write_line(cmd)
-        time.sleep(delay)
+        response = self.command(cmd)
+        if response != "ok":
+            print("RECV: %s" % response)
+        return response
 
 
-ser = serial.Serial(args.port, baudrate=57600)
+ser = wiretrace.open_port(args, args.port)
 with ReaderThread(ser, PrintLines) as protocol:
-    while(1):
-        protocol.tx()
-        time.sleep(10)
+    protocol.metrics = metrics.from_args(args)
+    protocol.setup()
+    if args.burst:
+        try:
+            protocol.burst(args.count, args.report)
+        except KeyboardInterrupt:
+            pass
+    else:
+        while args.count is None or protocol.frame_count < args.count:
+            protocol.tx()
+            time.sleep(args.interval)
@@ -0,0 +1,704 @@
+#!/usr/bin/env python3
+"""
+Software stand-in for the RN2903 / RN2483 module on a LoStik.
+
+Emulates the part of the RN2xx3 command set the examples use, with a timing
+model for the UART, command processing and LoRa airtime. Emulated sticks share
+an Ether so one running radio_sender.py can be heard by one running
+radio_receiver.py.
+
+Run it as a script to get pseudo terminals that the examples accept as their
+port argument unchanged:
+
+    ./rn2xx3_emulator.py --devices 2
+    RN2903 on /dev/pts/3
+    RN2903 on /dev/pts/4
+
+or use EmulatedSerial in-process wherever a serial.Serial is expected.
+"""
+import argparse
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+import serial
+
+from lostik import (DATA_RATES, JOIN_REQUEST_SIZE, MAC_OVERHEAD, mac_airtime, max_payload,
+                    time_on_air)
+
+VERSIONS = {
+    'RN2903': 'RN2903 1.0.3 Aug  8 2017 15:11:09',
+    'RN2483': 'RN2483 1.0.5 Oct 31 2018 15:06:52',
+}
+
+PAUSE_DURATION = '4294967245'
+
+
+class TimingModel(object):
+    """
+    Delays used by the emulator, in seconds. Everything is divided by speed,
+    so speed=10 runs a session ten times faster than a real stick.
+    """
+
+    def __init__(self, baudrate=57600, processing=.005, save=.1,
+                 join_delay=6.0, rx_windows=2.0, speed=1.0):
+        self.baudrate = baudrate
+        self.processing = processing
+        self.save = save
+        self.join_delay = join_delay
+        self.rx_windows = rx_windows
+        self.speed = speed
+
+    def uart(self, nbytes):
+        # 8N1 -> 10 bits per byte
+        return nbytes * 10.0 / self.baudrate / self.speed
+
+    def scale(self, seconds):
+        return seconds / self.speed
+
+
+class Ether(object):
+    """Radio medium shared by emulated devices"""
+
+    def __init__(self, rssi=-60, snr=9, loss=0.0):
+        self.rssi = rssi
+        self.snr = snr
+        self.loss = loss
+        self.devices = []
+        self._lock = threading.Lock()
+
+    def attach(self, device):
+        with self._lock:
+            self.devices.append(device)
+
+    def transmit(self, sender, settings, payload):
+        with self._lock:
+            listeners = [d for d in self.devices if d is not sender]
+        for device in listeners:
+            if random.random() >= self.loss:
+                device.hear(settings, payload, self.rssi, self.snr)
+
+
+class Device(object):
+    """State machine of one RN2xx3 module"""
+
+    def __init__(self, sku='RN2903', timing=None, ether=None, hweui=None, join_accept=1.0):
+        if sku not in VERSIONS:
+            raise ValueError('Unknown SKU %s' % sku)
+        self.sku = sku
+        self.timing = timing or TimingModel()
+        self.ether = ether
+        self.hweui = hweui or '0004A30B%08X' % random.getrandbits(32)
+        self.join_accept = join_accept
+        self.output = None
+        self._buffer = bytearray()
+        self._queue = []
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._ready_at = 0
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, name='rn2xx3')
+        self._thread.daemon = True
+        self._thread.start()
+        self._factory_reset()
+        self.saved = self._snapshot()
+        if ether is not None:
+            ether.attach(self)
+
+    # - - - state - - -
+
+    def _factory_reset(self):
+        self.mac = {
+            'deveui': '0' * 16,
+            'appeui': '0' * 16,
+            'appkey': '0' * 32,
+            'devaddr': '0' * 8,
+            'nwkskey': '0' * 32,
+            'appskey': '0' * 32,
+            'dr': '0',
+            'adr': 'off',
+            'ar': 'off',
+            'pwridx': '5' if self.sku == 'RN2903' else '1',
+            'retx': '7',
+            'upctr': '0',
+            'dnctr': '0',
+            'rxdelay1': '1000',
+            'rxdelay2': '2000',
+        }
+        self.channels = []
+        if self.sku == 'RN2903':
+            for ch in range(72):
+                if ch < 64:
+                    self.channels.append({'freq': str(902300000 + 200000 * ch),
+                                          'drrange': '0 3', 'status': 'on'})
+                else:
+                    self.channels.append({'freq': str(903000000 + 1600000 * (ch - 64)),
+                                          'drrange': '4 4', 'status': 'on'})
+        else:
+            for ch in range(16):
+                if ch < 3:
+                    self.channels.append({'freq': str(868100000 + 200000 * ch),
+                                          'drrange': '0 5', 'dcycle': '302', 'status': 'on'})
+                else:
+                    self.channels.append({'freq': '0', 'drrange': '0 0',
+                                          'dcycle': '0', 'status': 'off'})
+        self.nvm = {}
+        self._reset_runtime()
+
+    def _reset_runtime(self):
+        self.radio = {
+            'mod': 'lora',
+            'freq': '923300000' if self.sku == 'RN2903' else '868100000',
+            'pwr': '2' if self.sku == 'RN2903' else '1',
+            'sf': 'sf12',
+            'bw': '125',
+            'cr': '4/5',
+            'prlen': '8',
+            'crc': 'on',
+            'iqi': 'off',
+            'sync': '34',
+            'wdt': '15000',
+            'rxbw': '25',
+            'bitrate': '50000',
+            'fdev': '25000',
+        }
+        self.pins = {}
+        self.joined = False
+        self.paused = False
+        self.radio_state = None
+        self.mac_busy = False
+        self.snr = '-128'
+        self.rssi = '-128'
+        self._rx_token = None
+        self._channel_free = {}
+
+    def _snapshot(self):
+        return {
+            'mac': dict(self.mac),
+            'channels': [dict(c) for c in self.channels],
+        }
+
+    def _restore(self, saved):
+        self.mac = dict(saved['mac'])
+        self.channels = [dict(c) for c in saved['channels']]
+
+    def radio_settings(self):
+        return {
+            'freq': int(self.radio['freq']),
+            'sf': int(self.radio['sf'][2:]),
+            'bw': int(self.radio['bw']),
+            'cr': int(self.radio['cr'][2:]) - 4,
+            'prlen': int(self.radio['prlen']),
+            'crc': 1 if self.radio['crc'] == 'on' else 0,
+        }
+
+    # - - - transport side - - -
+
+    def feed(self, data):
+        """Bytes written to the module's UART"""
+        self._buffer.extend(data)
+        while b'\r\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\r\n', 1)
+            # _ready_at is shared with the replies sent from the scheduler thread
+            with self._cv:
+                start = max(time.monotonic(), self._ready_at) + self.timing.uart(len(line) + 2)
+                self._ready_at = start + self.timing.scale(self.timing.processing)
+                self.schedule_at(self._ready_at, self._command, line.decode('ascii', 'replace'))
+
+    def close(self):
+        with self._cv:
+            self._alive = False
+            self._cv.notify()
+
+    def schedule_at(self, when, fn, *args):
+        with self._cv:
+            heapq.heappush(self._queue, (when, next(self._seq), fn, args))
+            self._cv.notify()
+
+    def schedule(self, delay, fn, *args):
+        self.schedule_at(time.monotonic() + self.timing.scale(delay), fn, *args)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while self._alive:
+                    now = time.monotonic()
+                    if self._queue and self._queue[0][0] <= now:
+                        break
+                    self._cv.wait(self._queue[0][0] - now if self._queue else None)
+                if not self._alive:
+                    return
+                _, _, fn, args = heapq.heappop(self._queue)
+            fn(*args)
+
+    def _emit(self, line):
+        data = ('%s\r\n' % line).encode('ascii')
+        with self._cv:
+            self.schedule_at(max(time.monotonic(), self._ready_at) + self.timing.uart(len(data)),
+                             self._write, data)
+
+    def _write(self, data):
+        if self.output is not None:
+            self.output(data)
+
+    # - - - commands - - -
+
+    def _command(self, line):
+        words = line.split()
+        if not words:
+            return
+        handler = getattr(self, '_cmd_%s' % words[0], None)
+        if handler is None:
+            self._emit('invalid_param')
+            return
+        try:
+            response = handler(words[1:])
+        except (IndexError, ValueError, KeyError):
+            response = 'invalid_param'
+        if response is not None:
+            self._emit(response)
+
+    def _cmd_sys(self, words):
+        if words[0] == 'get':
+            if words[1] == 'ver':
+                return VERSIONS[self.sku]
+            if words[1] == 'hweui':
+                return self.hweui
+            if words[1] == 'vdd':
+                return '3300'
+            if words[1] == 'pindig':
+                return self.pins.get(words[2], '0')
+            if words[1] == 'nvm':
+                return '%02X' % self.nvm.get(self._nvm_address(words[2]), 0xFF)
+        elif words[0] == 'set':
+            if words[1] == 'pindig' and words[3] in ('0', '1'):
+                self.pins[words[2]] = words[3]
+                return 'ok'
+            if words[1] == 'nvm':
+                value = int(words[3], 16)
+                if not 0 <= value <= 0xFF:
+                    return 'invalid_param'
+                self.nvm[self._nvm_address(words[2])] = value
+                return 'ok'
+        elif words[0] == 'sleep':
+            self.schedule(int(words[1]) / 1000.0, self._emit, 'ok')
+            return None
+        elif words[0] == 'reset':
+            self._restore(self.saved)
+            self._reset_runtime()
+            self.schedule(.1, self._emit, VERSIONS[self.sku])
+            return None
+        elif words[0] == 'factoryRESET':
+            self._factory_reset()
+            self.saved = self._snapshot()
+            self.schedule(.1, self._emit, VERSIONS[self.sku])
+            return None
+        return 'invalid_param'
+
+    def _nvm_address(self, word):
+        address = int(word, 16)
+        if not 0x300 <= address <= 0x3FF:
+            raise ValueError(word)
+        return address
+
+    def _cmd_mac(self, words):
+        if words[0] == 'pause':
+            if self.mac_busy:
+                return '0'
+            self.paused = True
+            return PAUSE_DURATION
+        if words[0] == 'resume':
+            self.paused = False
+            return 'ok'
+        if words[0] == 'reset':
+            self._factory_reset()
+            return 'ok'
+        if words[0] == 'save':
+            self.saved = self._snapshot()
+            self.schedule(self.timing.save, self._emit, 'ok')
+            return None
+        if words[0] == 'join':
+            return self._mac_join(words[1])
+        if words[0] == 'tx':
+            return self._mac_tx(words[1], int(words[2]), words[3])
+        if words[0] == 'get':
+            if words[1] == 'ch':
+                return self.channels[int(words[3])][words[2]]
+            if words[1] == 'status':
+                return '%08X' % (1 if self.joined else 0)
+            if words[1] in ('appkey', 'nwkskey', 'appskey'):
+                return 'invalid_param'
+            return self.mac[words[1]]
+        if words[0] == 'set':
+            if words[1] == 'ch':
+                return self._mac_set_ch(words[2], int(words[3]), words[4:])
+            return self._mac_set(words[1], words[2])
+        return 'invalid_param'
+
+    def _mac_set(self, key, value):
+        lengths = {'deveui': 16, 'appeui': 16, 'devaddr': 8,
+                   'appkey': 32, 'nwkskey': 32, 'appskey': 32}
+        if key in lengths:
+            if len(value) != lengths[key]:
+                return 'invalid_param'
+            int(value, 16)
+            self.mac[key] = value.upper()
+        elif key == 'dr':
+            if int(value) not in DATA_RATES[self.sku]:
+                return 'invalid_param'
+            self.mac[key] = value
+        elif key in ('adr', 'ar'):
+            if value not in ('on', 'off'):
+                return 'invalid_param'
+            self.mac[key] = value
+        elif key in ('pwridx', 'retx', 'upctr', 'dnctr', 'rxdelay1'):
+            self.mac[key] = str(int(value))
+        else:
+            return 'invalid_param'
+        return 'ok'
+
+    def _mac_set_ch(self, key, ch, values):
+        channel = self.channels[ch]
+        if key == 'freq':
+            if self.sku == 'RN2903' or ch < 3:
+                return 'invalid_param'
+            if not 863000000 <= int(values[0]) <= 870000000:
+                return 'invalid_param'
+            channel['freq'] = values[0]
+        elif key == 'drrange':
+            low, high = int(values[0]), int(values[1])
+            if low > high or high not in DATA_RATES[self.sku]:
+                return 'invalid_param'
+            channel['drrange'] = '%d %d' % (low, high)
+        elif key == 'dcycle':
+            if self.sku == 'RN2903':
+                return 'invalid_param'
+            channel['dcycle'] = str(int(values[0]))
+        elif key == 'status':
+            if values[0] not in ('on', 'off'):
+                return 'invalid_param'
+            channel['status'] = values[0]
+        else:
+            return 'invalid_param'
+        return 'ok'
+
+    def _mac_join(self, mode):
+        if self.paused:
+            return 'mac_paused'
+        if self.mac_busy:
+            return 'busy'
+        if mode == 'otaa':
+            keys = ('deveui', 'appeui', 'appkey')
+        elif mode == 'abp':
+            keys = ('devaddr', 'nwkskey', 'appskey')
+        else:
+            return 'invalid_param'
+        if all(set(self.mac[k]) == {'0'} for k in keys):
+            return 'keys_not_init'
+        if mode == 'otaa' and self._pick_channel(JOIN_REQUEST_SIZE) is None:
+            return 'no_free_ch'
+        self.joined = False
+        if mode == 'abp':
+            self.schedule(self.timing.processing, self._joined, True)
+        else:
+            self.mac_busy = True
+            self.schedule(self.timing.join_delay, self._joined,
+                          random.random() < self.join_accept, True)
+        return 'ok'
+
+    def _pick_channel(self, length):
+        """
+        Pick a random enabled channel for the current data rate whose duty
+        cycle allows a length byte uplink now. Returns its time on air, or
+        None if every channel is still blocked.
+        """
+        dr = int(self.mac['dr'])
+        now = time.monotonic()
+        free = []
+        for ch, channel in enumerate(self.channels):
+            low, high = (int(x) for x in channel['drrange'].split())
+            if channel['status'] == 'on' and low <= dr <= high and self._channel_free.get(ch, 0) <= now:
+                free.append(ch)
+        if not free:
+            return None
+        ch = random.choice(free)
+        airtime = mac_airtime(self.sku, dr, length)
+        # dcycle X allows 1/(X+1) of the time on the channel
+        dcycle = int(self.channels[ch].get('dcycle', 0))
+        self._channel_free[ch] = now + self.timing.scale(airtime * (dcycle + 1))
+        return airtime
+
+    def _joined(self, accepted, otaa=False):
+        self.mac_busy = False
+        self.joined = accepted
+        if accepted and otaa:
+            # new session from the join accept, kept by mac save like ABP keys
+            self.mac['devaddr'] = '%08X' % random.getrandbits(32)
+            self.mac['nwkskey'] = '%032X' % random.getrandbits(128)
+            self.mac['appskey'] = '%032X' % random.getrandbits(128)
+            self.mac['upctr'] = '0'
+            self.mac['dnctr'] = '0'
+        self._emit('accepted' if accepted else 'denied')
+
+    def _mac_tx(self, kind, port, data):
+        if kind not in ('cnf', 'uncnf') or not 1 <= port <= 223 or len(data) % 2:
+            return 'invalid_param'
+        bytes.fromhex(data)
+        if self.paused:
+            return 'mac_paused'
+        if not self.joined:
+            return 'not_joined'
+        if self.mac_busy:
+            return 'busy'
+        if len(data) // 2 > max_payload(self.sku, int(self.mac['dr'])):
+            return 'invalid_data_len'
+        airtime = self._pick_channel(MAC_OVERHEAD + len(data) // 2)
+        if airtime is None:
+            return 'no_free_ch'
+        self.mac_busy = True
+        self.schedule(airtime + self.timing.rx_windows, self._mac_tx_done)
+        return 'ok'
+
+    def _mac_tx_done(self):
+        self.mac_busy = False
+        self.mac['upctr'] = str(int(self.mac['upctr']) + 1)
+        self._emit('mac_tx_ok')
+
+    def _cmd_radio(self, words):
+        if words[0] == 'get':
+            if words[1] == 'snr':
+                return self.snr
+            if words[1] == 'rssi':
+                return self.rssi
+            return self.radio[words[1]]
+        if words[0] == 'set':
+            return self._radio_set(words[1], words[2])
+        if words[0] == 'tx':
+            return self._radio_tx(words[1])
+        if words[0] == 'rx':
+            return self._radio_rx(int(words[1]))
+        if words[0] == 'rxstop':
+            return self._radio_rxstop()
+        return 'invalid_param'
+
+    def _radio_set(self, key, value):
+        choices = {
+            'mod': ('lora', 'fsk'),
+            'sf': tuple('sf%d' % sf for sf in range(7, 13)),
+            'bw': ('125', '250', '500'),
+            'cr': ('4/5', '4/6', '4/7', '4/8'),
+            'crc': ('on', 'off'),
+            'iqi': ('on', 'off'),
+        }
+        if key in choices:
+            if value not in choices[key]:
+                return 'invalid_param'
+        elif key == 'pwr':
+            low = 2 if self.sku == 'RN2903' else -3
+            if not low <= int(value) <= (20 if self.sku == 'RN2903' else 15):
+                return 'invalid_param'
+        elif key == 'freq':
+            if self.sku == 'RN2903' and not 902000000 <= int(value) <= 928000000:
+                return 'invalid_param'
+            if self.sku == 'RN2483' and not (433050000 <= int(value) <= 434790000 or
+                                              863000000 <= int(value) <= 870000000):
+                return 'invalid_param'
+        elif key in ('prlen', 'wdt', 'bitrate', 'fdev', 'sync'):
+            int(value, 16 if key == 'sync' else 10)
+        elif key == 'rxbw':
+            float(value)
+        else:
+            return 'invalid_param'
+        self.radio[key] = value
+        return 'ok'
+
+    def _radio_tx(self, data):
+        if len(data) % 2 or len(data) > 510:
+            return 'invalid_param'
+        payload = bytes.fromhex(data)
+        if not self.paused or self.radio_state is not None:
+            return 'busy'
+        settings = self.radio_settings()
+        airtime = time_on_air(settings['sf'], settings['bw'], settings['cr'],
+                              settings['prlen'], settings['crc'], len(payload))
+        self.radio_state = 'tx'
+        self.schedule(airtime, self._radio_tx_done, settings, payload)
+        return 'ok'
+
+    def _radio_tx_done(self, settings, payload):
+        self.radio_state = None
+        if self.ether is not None:
+            self.ether.transmit(self, settings, payload)
+        self._emit('radio_tx_ok')
+
+    def _radio_rx(self, symbols):
+        if not self.paused or self.radio_state is not None:
+            return 'busy'
+        self.radio_state = 'rx'
+        token = self._rx_token = object()
+        if symbols:
+            settings = self.radio_settings()
+            window = symbols * (2 ** settings['sf']) / (settings['bw'] * 1000.0)
+            self.schedule(window, self._radio_rx_timeout, token)
+        elif int(self.radio['wdt']):
+            self.schedule(int(self.radio['wdt']) / 1000.0, self._radio_rx_timeout, token)
+        return 'ok'
+
+    def _radio_rxstop(self):
+        # ends a pending receive without a radio_err
+        if self.radio_state == 'rx':
+            self.radio_state = None
+            self._rx_token = None
+        return 'ok'
+
+    def _radio_rx_timeout(self, token):
+        if self.radio_state == 'rx' and self._rx_token is token:
+            self.radio_state = None
+            self._emit('radio_err')
+
+    def hear(self, settings, payload, rssi, snr):
+        """Called by the Ether when another device finished a transmission"""
+        mine = self.radio_settings()
+        if self.radio_state != 'rx' or any(
+                mine[k] != settings[k] for k in ('freq', 'sf', 'bw')):
+            return
+        self.schedule_at(time.monotonic(), self._received, payload, rssi, snr)
+
+    def _received(self, payload, rssi, snr):
+        if self.radio_state != 'rx':
+            return
+        self.radio_state = None
+        self._rx_token = None
+        self.rssi = str(rssi)
+        self.snr = str(snr)
+        self._emit('radio_rx  %s' % payload.hex().upper())
+
+
+class EmulatedSerial(serial.SerialBase):
+    """In-process serial port connected to an emulated Device"""
+
+    def __init__(self, device=None, *args, **kwargs):
+        self.device = device or Device()
+        self._rx = bytearray()
+        self._rx_cv = threading.Condition()
+        self._cancel = False
+        kwargs.setdefault('baudrate', self.device.timing.baudrate)
+        super(EmulatedSerial, self).__init__(
+            'rn2xx3://%s' % self.device.sku, *args, **kwargs)
+
+    def open(self):
+        self.device.output = self._received
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        self.device.output = None
+        self.cancel_read()
+
+    def _reconfigure_port(self):
+        pass
+
+    def _received(self, data):
+        with self._rx_cv:
+            self._rx.extend(data)
+            self._rx_cv.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.SerialException('Attempting to use a port that is not open')
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        with self._rx_cv:
+            while len(self._rx) < size and self.is_open and not self._cancel:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._rx_cv.wait(remaining)
+            self._cancel = False
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException('Attempting to use a port that is not open')
+        self.device.feed(bytes(data))
+        return len(data)
+
+    def cancel_read(self):
+        with self._rx_cv:
+            self._cancel = True
+            self._rx_cv.notify_all()
+
+    def reset_input_buffer(self):
+        with self._rx_cv:
+            del self._rx[:]
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+def serve_pty(device):
+    """Expose device on a pseudo terminal and return the path of its slave end"""
+    import pty
+    import tty
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    device.output = lambda data: os.write(master, data)
+
+    def pump():
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            device.feed(data)
+
+    thread = threading.Thread(target=pump, name='pty')
+    thread.daemon = True
+    thread.start()
+    # keep the slave end open so the pty survives clients closing it
+    device.pty_slave = slave
+    return os.ttyname(slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate LoStik devices on pseudo terminals')
+    parser.add_argument('--sku', help="RN2903 or RN2483", choices=sorted(VERSIONS), default='RN2903')
+    parser.add_argument('--devices', '-n', help="Number of devices sharing one ether", type=int, default=1)
+    parser.add_argument('--baudrate', help="Emulated UART speed", type=int, default=57600)
+    parser.add_argument('--processing', help="Command processing time in seconds", type=float, default=.005)
+    parser.add_argument('--join-delay', help="Seconds until a join is accepted", type=float, default=6.0)
+    parser.add_argument('--speed', help="Time scale, 10 runs ten times faster", type=float, default=1.0)
+    parser.add_argument('--loss', help="Packet loss probability between devices", type=float, default=0.0)
+    parser.add_argument('--join-accept', help="Probability that an OTAA join is accepted",
+                        type=float, default=1.0)
+    args = parser.parse_args()
+
+    timing = TimingModel(baudrate=args.baudrate, processing=args.processing,
+                         join_delay=args.join_delay, speed=args.speed)
+    ether = Ether(loss=args.loss)
+    for _ in range(args.devices):
+        device = Device(args.sku, timing, ether, join_accept=args.join_accept)
+        print("%s on %s" % (args.sku, serve_pty(device)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Receive on several LoStiks at once and merge what they hear.
+
+Every stick listens in radio mode (optionally on its own frequency / spreading
+factor). Frames are merged into one stream ordered by the time they were
+first heard; a frame heard by more than one stick within --window seconds is
+printed once, with the best SNR/RSSI and the number of sticks that heard it.
+
+    ./rx_aggregator.py /dev/ttyUSB0 /dev/ttyUSB1:868300000:sf9
+"""
+import argparse
+import asyncio
+import re
+import time
+from collections import OrderedDict
+
+from lostik import CommandError, CommandTimeout, int_reply
+from lostik_async import AsyncLoStik
+import metrics
+
+# Seconds to wait for the RSSI/SNR of a frame before re-arming the receiver
+# without them
+QUALITY_TIMEOUT = .5
+
+FREQ = re.compile(r'^(\d{6,})?$')
+SF = re.compile(r'^sf\d+$', re.IGNORECASE)
+
+
+class Frame(object):
+
+    def __init__(self, timestamp, port, payload, freq=None, sf=None, rssi=None, snr=None):
+        self.timestamp = timestamp
+        self.port = port
+        self.payload = payload
+        self.freq = freq
+        self.sf = sf
+        self.rssi = rssi
+        self.snr = snr
+        self.ports = {port}
+
+    def quality(self):
+        return (self.snr if self.snr is not None else -128,
+                self.rssi if self.rssi is not None else -200)
+
+    def __str__(self):
+        return '%.3f %s %s %s rssi=%s snr=%s heard_by=%d %s' % (
+            self.timestamp, self.port, self.freq, self.sf, self.rssi, self.snr,
+            len(self.ports), self.payload)
+
+
+class Deduplicator(object):
+    """
+    Time-windowed duplicate filter. Frames are held for window seconds after
+    they are first heard so copies from other sticks can be merged, then
+    released in the order they were first heard. When more than max_entries
+    frames are held the oldest are released early, which keeps memory flat
+    under sustained load.
+    """
+
+    def __init__(self, window=.5, max_entries=10000):
+        self.window = window
+        self.max_entries = max_entries
+        self.pending = OrderedDict()
+
+    def add(self, frame):
+        best = self.pending.get(frame.payload)
+        if best is None:
+            self.pending[frame.payload] = frame
+            return
+        ports = best.ports | frame.ports
+        if frame.quality() > best.quality():
+            frame.timestamp = best.timestamp
+            self.pending[frame.payload] = best = frame
+        best.ports = ports
+
+    def expire(self, now):
+        """Return the frames whose window has closed, oldest first"""
+        released = []
+        while self.pending:
+            payload, frame = next(iter(self.pending.items()))
+            if frame.timestamp + self.window > now and len(self.pending) <= self.max_entries:
+                break
+            del self.pending[payload]
+            released.append(frame)
+        return released
+
+    def flush(self):
+        return self.expire(float('inf'))
+
+
+def parse_port(spec):
+    """
+    port[:freq[:sf]], taken apart from the right so ports with colons of
+    their own (rfc2217://host:port) work. freq is in Hz, sf like sf9.
+    """
+    port, freq, sf = spec, None, None
+    head, _, tail = port.rpartition(':')
+    if head and SF.match(tail):
+        port, sf = head, tail
+        head, _, tail = port.rpartition(':')
+    if head and FREQ.match(tail):
+        port, freq = head, tail or None
+    return port, freq, sf
+
+
+async def quality(stik):
+    """(rssi, snr) of the last frame, Nones if unsupported or slow to answer"""
+    try:
+        return (int_reply(await stik.command('radio get rssi', QUALITY_TIMEOUT)),
+                int_reply(await stik.command('radio get snr', QUALITY_TIMEOUT)))
+    except CommandTimeout:
+        return None, None
+
+
+async def receive(spec, dedup, stats=None):
+    port, freq, sf = parse_port(spec)
+    stik = await AsyncLoStik.open(port)
+    stik.metrics = stats
+    await stik.command('mac pause')
+    if freq:
+        await stik.command_ok('radio set freq %s' % freq)
+    if sf:
+        await stik.command_ok('radio set sf %s' % sf)
+    freq = await stik.command('radio get freq')
+    sf = await stik.command('radio get sf')
+    while True:
+        try:
+            line = await stik.transact('radio rx 0')
+        except CommandError as e:
+            print("%s: %s" % (port, e))
+            await asyncio.sleep(1)
+            continue
+        if not line.startswith('radio_rx'):
+            continue
+        timestamp = time.time()
+        rssi, snr = await quality(stik)
+        dedup.add(Frame(timestamp, port, line.split()[1], freq, sf, rssi, snr))
+
+
+async def emit(dedup):
+    while True:
+        await asyncio.sleep(dedup.window / 4)
+        for frame in dedup.expire(time.time()):
+            print(frame)
+
+
+async def aggregate(args):
+    dedup = Deduplicator(args.window, args.max_entries)
+    stats = metrics.from_args(args)
+    await asyncio.gather(emit(dedup), *(receive(spec, dedup, stats) for spec in args.ports))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge and deduplicate frames heard by several LoStiks')
+    parser.add_argument('ports', nargs='+', help="Serial ports, optionally port:freq:sf")
+    parser.add_argument('--window', '-w', help="Seconds to wait for copies of a frame", type=float, default=.5)
+    parser.add_argument('--max-entries', help="Maximum number of frames held for deduplication",
+                        type=int, default=10000)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(aggregate(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Channel plan scanning with adaptive dwell.
+
+A scan visits every channel of a plan once per sweep and listens on it for a
+dwell time. Every channel gets at least min_dwell seconds; the rest of the
+sweep is shared out in proportion to how many frames per second each channel
+has been carrying lately, so busy channels get more listen time while quiet
+ones are still sampled every sweep.
+
+    scanner = Scanner(load_plan('ttn-us.conf'), min_dwell=.5)
+    for channel in scanner.channels:
+        dwell = scanner.dwell(channel)
+        ... listen on channel.freq / channel.bw for dwell seconds ...
+        scanner.record(channel, listened, frames, rssi)
+    print('\\n'.join(scanner.heatmap()))
+
+Plans are the [channels] section of a configure.py config file; every
+channel with a frequency is scanned, whether it is on or off. RN2903
+channels 64-71 are 500 kHz wide.
+"""
+import configparser
+
+# RN2903 channels from this one up are 500 kHz wide
+FIRST_WIDE_CHANNEL = 64
+
+# Characters for increasing activity in the heatmap
+HEAT = ' .:-=+*#%@'
+
+
+class ScanChannel(object):
+
+    def __init__(self, index, freq, bw=125):
+        self.index = index
+        self.freq = freq
+        self.bw = bw
+        self.listened = 0.0
+        self.frames = 0
+        self.rssi = []
+        # frames per second, smoothed over recent sweeps
+        self.activity = None
+        # frames per second of each visit
+        self.history = []
+
+    @property
+    def rate(self):
+        """Frames per minute over the whole scan"""
+        return 60 * self.frames / self.listened if self.listened else 0.0
+
+
+def load_plan(path):
+    """Channels of the [channels] section of a configure.py config file"""
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise IOError('cannot read %s' % path)
+    channels = []
+    for name, value in config.items('channels'):
+        index = int(name.replace('ch', '').strip())
+        freq = value.split(',')[0].replace('"', '').strip()
+        if not freq:
+            continue
+        channels.append(ScanChannel(index, int(freq), 500 if index >= FIRST_WIDE_CHANNEL else 125))
+    return channels
+
+
+class Scanner(object):
+
+    def __init__(self, channels, min_dwell=1.0, sweep=None, smoothing=.3):
+        if not channels:
+            raise ValueError('empty channel plan')
+        self.channels = channels
+        self.min_dwell = min_dwell
+        # seconds per sweep, by default twice the minimum
+        self.sweep = sweep if sweep is not None else 2 * min_dwell * len(channels)
+        self.smoothing = smoothing
+        self.sweeps = 0
+
+    def dwell(self, channel):
+        """Seconds to listen on channel during this sweep"""
+        total = sum(c.activity or 0 for c in self.channels)
+        if not total:
+            return max(self.min_dwell, self.sweep / len(self.channels))
+        spare = max(0.0, self.sweep - self.min_dwell * len(self.channels))
+        return self.min_dwell + spare * (channel.activity or 0) / total
+
+    def record(self, channel, listened, frames, rssi=()):
+        """Account for a visit to channel"""
+        rate = frames / listened if listened > 0 else 0.0
+        if channel.activity is None:
+            channel.activity = rate
+        else:
+            channel.activity += self.smoothing * (rate - channel.activity)
+        channel.listened += listened
+        channel.frames += frames
+        channel.rssi.extend(rssi)
+        channel.history.append(rate)
+        if channel is self.channels[-1]:
+            self.sweeps += 1
+
+    def heatmap(self, width=60):
+        """Lines of per channel totals and activity of the last width visits"""
+        peak = max([rate for c in self.channels for rate in c.history[-width:]] or [0])
+        lines = ['%-4s %-9s %-3s %8s %6s %8s %6s  %s' % (
+            'CH', 'FREQ', 'BW', 'LISTENED', 'FRAMES', 'PER MIN', 'RSSI', 'ACTIVITY')]
+        for c in self.channels:
+            heat = ''.join(
+                HEAT[min(len(HEAT) - 1, int(round(rate / peak * (len(HEAT) - 1))))] if peak else HEAT[0]
+                for rate in c.history[-width:])
+            lines.append('%-4d %-9d %-3d %7.1fs %6d %8.2f %6s  |%s|' % (
+                c.index, c.freq, c.bw, c.listened, c.frames, c.rate,
+                '%.0f' % (sum(c.rssi) / float(len(c.rssi))) if c.rssi else '-', heat))
+        return lines
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Coalescing queue for LoRaWAN uplink payloads.
+
+Sensors usually produce small readings more often than the duty cycle allows
+an uplink, and every uplink costs MAC_OVERHEAD bytes plus preamble airtime
+whatever its size. UplinkQueue collects readings and hands them out as
+batches that fill the largest payload the current data rate allows, or
+whatever has accumulated once the oldest reading has waited max_latency
+seconds.
+
+    uplinks = UplinkQueue(max_latency=60)
+    uplinks.put(struct.pack('>I', int(time.time())))    # from any thread
+    ...
+    payload = uplinks.get_batch(max_payload('RN2483', dr))
+
+Readings are concatenated as they are, so they should be fixed size or
+self-delimiting for the application server to split them again.
+"""
+import threading
+import time
+from collections import deque
+
+
+class UplinkQueue(object):
+
+    def __init__(self, max_latency=60.0, clock=time.monotonic):
+        self.max_latency = max_latency
+        self.clock = clock
+        self.readings = deque()
+        self.size = 0
+        # readings larger than the maximum payload, which can never be sent
+        self.dropped = 0
+        self._cv = threading.Condition()
+
+    def __len__(self):
+        return len(self.readings)
+
+    def put(self, reading):
+        with self._cv:
+            self.readings.append((self.clock(), bytes(reading)))
+            self.size += len(reading)
+            self._cv.notify()
+
+    def _ready(self, max_size, max_latency):
+        if not self.readings:
+            return None
+        if self.size >= max_size:
+            return 0
+        return max(0, self.readings[0][0] + max_latency - self.clock())
+
+    def get_batch(self, max_size, timeout=None, max_latency=None):
+        """
+        Wait until max_size bytes of readings are pending or the oldest one
+        is max_latency seconds old, and return as many whole readings as fit
+        in max_size bytes. Returns b'' if timeout expires first.
+        """
+        if max_latency is None:
+            max_latency = self.max_latency
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._cv:
+            while True:
+                wait = self._ready(max_size, max_latency)
+                if wait == 0:
+                    break
+                if deadline is not None:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return b''
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cv.wait(wait)
+            batch = bytearray()
+            while self.readings:
+                reading = self.readings[0][1]
+                if len(reading) > max_size:
+                    self.readings.popleft()
+                    self.size -= len(reading)
+                    self.dropped += 1
+                    continue
+                if len(batch) + len(reading) > max_size:
+                    break
+                self.readings.popleft()
+                self.size -= len(reading)
+                batch.extend(reading)
+            return bytes(batch)
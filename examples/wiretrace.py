@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Serial wire tracing and replay.
+
+TracingSerial wraps a serial port and records every byte read from and
+written to it, with monotonic timestamps, in a compact binary trace file:
+a 24 byte header (magic, version, wall clock start time) followed by one
+record per read or write (direction, seconds since the start, length, data).
+
+    ser = TracingSerial(serial.Serial(port, baudrate=57600), TraceWriter('stick.trc'))
+
+A trace can be played back in either direction, at the recorded speed or
+faster. ReplaySerial stands in for the device: it answers a script with the
+recorded module output, each line after the same delay as recorded (divided
+by speed) counted from when the script sent the command it answers. Run as a
+script, wiretrace.py plays the host side of a trace into a real or emulated
+module and compares the replies.
+
+    ./radio_sender.py --trace sender.trc /dev/ttyUSB0
+    ./radio_sender.py --replay sender.trc --replay-speed 10 -
+    ./wiretrace.py replay sender.trc /dev/pts/3 --speed 10
+    ./wiretrace.py dump sender.trc
+
+The pacing is by line: a recorded reply is only released once the other side
+has sent as many lines as it had at that point of the recording, so a replay
+stays in step even when one side is faster or slower than it was.
+"""
+import argparse
+import struct
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+import serial
+
+from discovery import resolve
+from lostik import BAUDRATE
+
+MAGIC = b'LSTKTRC1'
+VERSION = 1
+# magic, version, reserved, wall clock time of the start
+HEADER = struct.Struct('<8sHxxxxxxd')
+# direction, seconds since the start, data length
+RECORD = struct.Struct('<cdH')
+RX = b'R'
+TX = b'T'
+MAX_CHUNK = 0xFFFF
+
+# Seconds between flushes of the trace file
+FLUSH_INTERVAL = 1.0
+
+TraceRecord = namedtuple('TraceRecord', 'time direction data')
+
+
+class TraceWriter(object):
+
+    def __init__(self, path, clock=time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.start = clock()
+        self._flushed = self.start
+        self._lock = threading.Lock()
+
+    def record(self, direction, data):
+        if not data:
+            return
+        with self._lock:
+            if self.file.closed:
+                return
+            now = self.clock()
+            for i in range(0, len(data), MAX_CHUNK):
+                chunk = data[i:i + MAX_CHUNK]
+                self.file.write(RECORD.pack(direction, now - self.start, len(chunk)))
+                self.file.write(chunk)
+            if now - self._flushed >= FLUSH_INTERVAL:
+                self.file.flush()
+                self._flushed = now
+
+    def rx(self, data):
+        self.record(RX, data)
+
+    def tx(self, data):
+        self.record(TX, data)
+
+    def flush(self):
+        with self._lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TraceReader(object):
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        if len(self.data) < HEADER.size:
+            raise ValueError('%s is not a trace file' % path)
+        magic, version, self.started = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a trace file' % path)
+
+    def __iter__(self):
+        offset = HEADER.size
+        # a record cut short by a crash ends the trace
+        while offset + RECORD.size <= len(self.data):
+            direction, timestamp, length = RECORD.unpack_from(self.data, offset)
+            start = offset + RECORD.size
+            offset = start + length
+            if direction not in (RX, TX) or offset > len(self.data):
+                break
+            yield TraceRecord(timestamp, direction, self.data[start:offset])
+
+
+class TracingSerial(object):
+    """
+    Serial port wrapper that passes everything through to the port and
+    records reads and writes in a TraceWriter.
+    """
+
+    def __init__(self, serial_instance, trace):
+        self.__dict__['serial'] = serial_instance
+        self.__dict__['trace'] = trace
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.serial, name, value)
+
+    def read(self, size=1):
+        data = self.serial.read(size)
+        self.trace.rx(data)
+        return data
+
+    def write(self, data):
+        result = self.serial.write(data)
+        self.trace.tx(bytes(data))
+        return result
+
+    def close(self):
+        self.serial.close()
+        self.trace.flush()
+
+
+class Replayer(object):
+    """
+    Play the records of one direction of a trace to output, paced by the
+    lines fed in from the other side.
+    """
+
+    def __init__(self, records, play, output, speed=1.0, patience=None, clock=time.monotonic):
+        self.records = list(records)
+        self.play = play
+        self.output = output
+        self.speed = speed
+        # longest to wait for a line from the other side, None for ever
+        self.patience = patience
+        self.clock = clock
+        # lines the other side sent in the recording
+        self.expected = b''.join(
+            r.data for r in self.records if r.direction != play).split(b'\n')[:-1]
+        self.lines = 0
+        self.mismatches = []
+        self.stalls = 0
+        self.finished = threading.Event()
+        self._partial = bytearray()
+        # (line count, clock) whenever lines arrived
+        self._arrivals = deque()
+        self._cv = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='replay')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cv:
+            self._stop = True
+            self._cv.notify_all()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def feed(self, data):
+        """Data from the other side"""
+        now = self.clock()
+        with self._cv:
+            self._partial.extend(data)
+            lines = self._partial.split(b'\n')
+            if len(lines) == 1:
+                return
+            self._partial[:] = lines.pop()
+            for line in lines:
+                if self.lines < len(self.expected) and line != self.expected[self.lines]:
+                    self.mismatches.append((self.lines, self.expected[self.lines], bytes(line)))
+                self.lines += 1
+            self._arrivals.append((self.lines, now))
+            self._cv.notify_all()
+
+    def _wait_lines(self, count):
+        """Wait until count lines have arrived, returns when the last of them did"""
+        deadline = None if self.patience is None else self.clock() + self.patience
+        with self._cv:
+            while self.lines < count and not self._stop:
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    # count the missing lines as lost and carry on
+                    self.stalls += 1
+                    self.lines = count
+                    return self.clock()
+                self._cv.wait(remaining)
+            while self._arrivals and self._arrivals[0][0] < count:
+                self._arrivals.popleft()
+            return self._arrivals[0][1] if self._arrivals else self.clock()
+
+    def _sleep_until(self, when):
+        with self._cv:
+            while not self._stop:
+                remaining = when - self.clock()
+                if remaining <= 0:
+                    break
+                self._cv.wait(remaining)
+
+    def _run(self):
+        anchor = self.clock()
+        previous = 0.0
+        count = 0
+        try:
+            for record in self.records:
+                if self._stop:
+                    break
+                if record.direction == self.play:
+                    if self.speed:
+                        anchor = anchor + (record.time - previous) / self.speed
+                        self._sleep_until(anchor)
+                    self.output(record.data)
+                    previous = record.time
+                else:
+                    lines = record.data.count(b'\n')
+                    if lines:
+                        count += lines
+                        anchor = self._wait_lines(count)
+                        previous = record.time
+        finally:
+            self.finished.set()
+
+
+class ReplaySerial(serial.SerialBase):
+    """Serial port that replays the module side of a trace"""
+
+    def __init__(self, path, speed=1.0, *args, **kwargs):
+        self.trace_path = path
+        self.speed = speed
+        self.replayer = None
+        self._rx = bytearray()
+        self._rx_cv = threading.Condition()
+        self._cancel = False
+        self._warned = False
+        kwargs.setdefault('baudrate', BAUDRATE)
+        super(ReplaySerial, self).__init__('replay://%s' % path, *args, **kwargs)
+
+    def open(self):
+        self.replayer = Replayer(TraceReader(self.trace_path), RX, self._received, self.speed)
+        self.is_open = True
+        self.replayer.start()
+        waiter = threading.Thread(target=self._wait_finished, name='replay-end')
+        waiter.daemon = True
+        waiter.start()
+
+    def close(self):
+        self.is_open = False
+        if self.replayer is not None:
+            self.replayer.stop()
+        self.cancel_read()
+
+    def _reconfigure_port(self):
+        pass
+
+    def _received(self, data):
+        with self._rx_cv:
+            self._rx.extend(data)
+            self._rx_cv.notify_all()
+
+    def _wait_finished(self):
+        self.replayer.finished.wait()
+        with self._rx_cv:
+            self._rx_cv.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.SerialException('Attempting to use a port that is not open')
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        with self._rx_cv:
+            while len(self._rx) < size and self.is_open and not self._cancel:
+                if not self._rx and self.replayer.finished.is_set():
+                    raise serial.SerialException('end of trace %s' % self.trace_path)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._rx_cv.wait(remaining)
+            self._cancel = False
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException('Attempting to use a port that is not open')
+        self.replayer.feed(bytes(data))
+        if self.replayer.mismatches and not self._warned:
+            self._warned = True
+            index, expected, got = self.replayer.mismatches[0]
+            sys.stderr.write('replay: line %d was %r in the trace, now %r\n' % (index + 1, expected, got))
+        return len(data)
+
+    def cancel_read(self):
+        with self._rx_cv:
+            self._cancel = True
+            self._rx_cv.notify_all()
+
+    def reset_input_buffer(self):
+        with self._rx_cv:
+            del self._rx[:]
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+def add_arguments(parser):
+    parser.add_argument('--trace', help="Record all serial traffic to this trace file")
+    parser.add_argument('--replay', help="Replay the module side of this trace file instead of using the port")
+    parser.add_argument('--replay-speed', help="Replay this many times faster than recorded, 0 for no delays",
+                        type=float, default=1)
+
+
+def open_port(args, port, baudrate=BAUDRATE):
+    """
+    Serial port for a script, replayed and/or traced as asked on the command
+    line. port can also be an hweui or 'auto', see discovery.py.
+    """
+    if args.replay:
+        ser = ReplaySerial(args.replay, args.replay_speed)
+    else:
+        ser = serial.Serial(resolve(port), baudrate=baudrate)
+    if args.trace:
+        ser = TracingSerial(ser, TraceWriter(args.trace))
+    return ser
+
+
+def dump(path):
+    reader = TraceReader(path)
+    print('# started %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.started)))
+    for record in reader:
+        print('%10.6f %s %r' % (record.time, 'RX' if record.direction == RX else 'TX', record.data))
+
+
+def replay_host(path, port, speed, timeout, trace=None):
+    """Send the host side of a trace to port and compare the replies"""
+    ser = serial.serial_for_url(port, baudrate=BAUDRATE, timeout=0.1)
+    if trace:
+        ser = TracingSerial(ser, TraceWriter(trace))
+    records = list(TraceReader(path))
+    replayer = Replayer(records, TX, ser.write, speed, patience=timeout)
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            replayer.feed(ser.read(ser.in_waiting or 1))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    start = time.monotonic()
+    replayer.start()
+    reader.start()
+    replayer.join()
+    elapsed = time.monotonic() - start
+    # give the replies to the last command a chance to arrive
+    deadline = time.monotonic() + timeout
+    while replayer.lines < len(replayer.expected) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    done.set()
+    reader.join()
+    ser.close()
+
+    recorded = records[-1].time if records else 0.0
+    for index, expected, got in replayer.mismatches:
+        print('line %d: expected %r, got %r' % (index + 1, expected, got))
+    print('%d/%d replies, %d differ, %d timed out' % (
+        min(replayer.lines, len(replayer.expected)), len(replayer.expected),
+        len(replayer.mismatches), replayer.stalls))
+    print('replayed %.3f s of trace in %.3f s' % (recorded, elapsed))
+    return not replayer.mismatches and not replayer.stalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dump or replay a serial trace')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    dump_parser = commands.add_parser('dump', help="Print the records of a trace")
+    dump_parser.add_argument('trace', help="Trace file")
+    replay_parser = commands.add_parser('replay', help="Send the host side of a trace to a module")
+    replay_parser.add_argument('trace', help="Trace file")
+    replay_parser.add_argument('port', help="Serial port of LoStik or emulator")
+    replay_parser.add_argument('--speed', help="Replay this many times faster than recorded, 0 for no delays",
+                               type=float, default=1)
+    replay_parser.add_argument('--timeout', help="Seconds to wait for each reply", type=float, default=30)
+    replay_parser.add_argument('--trace-output', help="Record the replayed session to this trace file")
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        dump(args.trace)
+    else:
+        sys.exit(0 if replay_host(args.trace, args.port, args.speed, args.timeout, args.trace_output) else 1)
+
+
+if __name__ == '__main__':
+    main()